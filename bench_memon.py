@@ -0,0 +1,287 @@
+#!/usr/bin/python
+# Benchmarks poll cycles against local stand-ins for AWS (ddbmock and moto,
+# as used by the tests, or the sqlite backend) and reports the wall time,
+# the requests made to each service and the DynamoDB capacity consumed per
+# cycle as JSON. Only the AWS stand-ins count requests. eg
+#
+#   python bench_memon.py --events 5000 --heartbeats 500 --due-table \
+#       --output bench.json
+import argparse
+import boto
+import boto.connection
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from memon import EventCache
+from memon import MEMon
+from memon import PeriodType
+from memon import ResourceCache
+from memon import Schema
+from memon import SqliteBackend
+
+DYNAMODB_READS = ('GetItem', 'BatchGetItem', 'Query', 'Scan')
+
+
+class Counter(object):
+    # Counts the requests boto makes to each service and the DynamoDB
+    # capacity they consume
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = {}
+        self.capacity = {'read': 0.0, 'write': 0.0}
+
+    def count(self, service, action):
+        key = '%s.%s' % (service, action)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def consumed(self, action, response):
+        units = 0.0
+        if isinstance(response, dict):
+            units = response.get('ConsumedCapacityUnits', 0)
+            # batch responses report per table
+            for table in response.get('Responses', {}).values():
+                if isinstance(table, dict):
+                    units += table.get('ConsumedCapacityUnits', 0)
+        kind = 'read' if action in DYNAMODB_READS else 'write'
+        self.capacity[kind] += units
+
+    def install(self):
+        counter = self
+
+        query_request = boto.connection.AWSQueryConnection.make_request
+        self.original = query_request
+
+        def make_query_request(self, action, *args, **kwargs):
+            service = self.__class__.__name__.replace('Connection', '')
+            counter.count(service.lower(), action)
+            return query_request(self, action, *args, **kwargs)
+        boto.connection.AWSQueryConnection.make_request = make_query_request
+
+    def install_dynamodb(self, layer1):
+        # ddbmock patches Layer1 itself and memon wraps the connection's
+        # make_request when it's set, so this has to wrap it after both
+        counter = self
+        dynamodb_request = layer1.make_request
+
+        def make_dynamodb_request(action, *args, **kwargs):
+            counter.count('dynamodb', action)
+            response = dynamodb_request(action, *args, **kwargs)
+            counter.consumed(action, response)
+            return response
+        layer1.make_request = make_dynamodb_request
+
+    def uninstall(self):
+        boto.connection.AWSQueryConnection.make_request = self.original
+
+
+def init_aws(memon, args):
+    from ddbmock import connect_boto_patch
+    from ddbmock.database.db import dynamodb
+    from ddbmock.database.key import PrimaryKey
+    from ddbmock.database.table import Table
+    from moto import mock_sns
+    from moto import mock_sqs
+
+    # only ever talks to the mocks
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    mock_sqs().start()
+    mock_sns().start()
+
+    dynamodb.hard_reset()
+    dynamodb.data[memon.table_name] = Table(
+        memon.table_name, 1, 1, PrimaryKey(u'Name', u'S'), None)
+    if args.due_table:
+        dynamodb.data[memon.due_table_name] = Table(
+            memon.due_table_name, 1, 1,
+            PrimaryKey(u'Bucket', u'N'), PrimaryKey(u'Due', u'S'))
+    memon.db = connect_boto_patch()
+    memon.sqs = boto.connect_sqs()
+    memon.sns_conn = boto.connect_sns()
+    memon.sqs.create_queue(memon.queue)
+    memon.sns_conn.create_topic(memon.sns)
+    memon.load_tables()
+
+
+def seed(memon, args, rnd):
+    # Events are spread over their period, with args.down of them overdue
+    events = []
+    down = int(args.events * args.down)
+    for i in xrange(args.events):
+        if i < down:
+            next_block = memon.now - 1
+        else:
+            next_block = memon.now + rnd.randint(1, args.period)
+        attrs = {
+            Schema.Period: args.period,
+            Schema.Enabled: 1,
+            Schema.Type: PeriodType.Rolling if i % 2 else PeriodType.Fixed,
+            Schema.ErrorCount: 0,
+            Schema.LastBlockTime: next_block - args.period,
+            Schema.NextBlockTime: next_block,
+            Schema.LastSuccessTime: next_block - args.period,
+        }
+        events.append(memon.table.new_item(hash_key='event-%06d' % (i),
+                                           attrs=attrs))
+    memon.save_batch(events)
+    return ['event-%06d' % (i) for i in xrange(down, args.events)]
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    memon = MEMon()
+    memon.wait_time = 0
+    memon.digest = args.digest
+    memon.batch_writes = args.batch_writes
+    memon.due_buckets = args.due_buckets
+    # the mocks' provisioned capacity means nothing, so don't pace to it
+    memon.capacity.burst = 0
+    memon.now = int(time.time())
+    tmp = tempfile.mkdtemp()
+    # installed before any connection is made, as memon wraps each
+    # connection's make_request when it's set
+    counter = Counter()
+    counter.install()
+    try:
+        if args.resource_cache:
+            memon.resources = ResourceCache(
+                os.path.join(tmp, 'resources.json'), memon.resource_ttl)
+        if args.cache:
+            memon.cache = EventCache(os.path.join(tmp, 'cache.db'))
+        if args.backend == 'sqlite':
+            memon.backend = SqliteBackend(os.path.join(tmp, 'memon.db'))
+            memon.load_tables()
+        else:
+            init_aws(memon, args)
+            counter.install_dynamodb(memon.db.layer1)
+        up = seed(memon, args, rnd)
+
+        cycles = []
+        for cycle in xrange(args.cycles):
+            memon.now += 60
+            for name in rnd.sample(up, min(args.heartbeats, len(up))):
+                memon.send(name)
+            counter.reset()
+            cycles.append(run_cycle(memon, args, counter))
+    finally:
+        counter.uninstall()
+        shutil.rmtree(tmp)
+
+    return {
+        'workload': vars(args),
+        'cycles': cycles,
+        'mean': {
+            'seconds': sum(c['seconds'] for c in cycles) / len(cycles),
+            'requests': (sum(sum(c['requests'].values()) for c in cycles) /
+                         float(len(cycles))),
+            'read_capacity': (sum(c['capacity']['read'] for c in cycles) /
+                              len(cycles)),
+            'write_capacity': (sum(c['capacity']['write'] for c in cycles) /
+                               len(cycles)),
+        },
+    }
+
+
+def run_cycle(memon, args, counter):
+    timings = {}
+    start = time.time()
+    if memon.cache:
+        memon.refresh_cache()
+    timings['refresh_cache'] = time.time() - start
+    started = time.time()
+    # every heartbeat plus one empty receive
+    heartbeats = memon.poll(args.heartbeats // 10 + 2)
+    timings['poll'] = time.time() - started
+    started = time.time()
+    memon.notify_down_events()
+    memon.flush_alerts()
+    timings['notify_down_events'] = time.time() - started
+    return {
+        'seconds': time.time() - start,
+        'timings': timings,
+        'heartbeats': heartbeats,
+        'requests': dict(counter.requests),
+        'capacity': dict(counter.capacity),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MEMon poll benchmark')
+    parser.add_argument('--events',
+                        type=int,
+                        default=1000,
+                        help='Configured events (default: %(default)s)')
+    parser.add_argument('--heartbeats',
+                        type=int,
+                        default=100,
+                        help=('Heartbeats sent before each poll '
+                              '(default: %(default)s)'))
+    parser.add_argument('--down',
+                        type=float,
+                        default=0.05,
+                        help=('Fraction of events overdue '
+                              '(default: %(default)s)'))
+    parser.add_argument('--period',
+                        type=int,
+                        default=3600,
+                        help='Event period (default: %(default)s)')
+    parser.add_argument('--cycles',
+                        type=int,
+                        default=3,
+                        help='Poll cycles to run (default: %(default)s)')
+    parser.add_argument('--backend',
+                        default='aws',
+                        choices=['aws', 'sqlite'],
+                        help=('aws runs against ddbmock and moto '
+                              '(default: %(default)s)'))
+    parser.add_argument('--due-table',
+                        default=False,
+                        action='store_true',
+                        help='Use the due index table')
+    parser.add_argument('--due-buckets',
+                        type=int,
+                        default=1,
+                        help='Due index buckets (default: %(default)s)')
+    parser.add_argument('--cache',
+                        default=False,
+                        action='store_true',
+                        help='Use a local event cache')
+    parser.add_argument('--no-resource-cache',
+                        dest='resource_cache',
+                        default=True,
+                        action='store_false',
+                        help=('Look up the queue url and topic arn every '
+                              'time, as without --resource-cache'))
+    parser.add_argument('--digest',
+                        default=False,
+                        action='store_true',
+                        help='Send alerts as a digest')
+    parser.add_argument('--batch-writes',
+                        default=False,
+                        action='store_true',
+                        help='Save heartbeats with BatchWriteItem')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=1,
+                        help='Random seed (default: %(default)s)')
+    parser.add_argument('--output',
+                        default=None,
+                        help='Write the results here rather than stdout')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
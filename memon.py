@@ -1,15 +1,27 @@
 #!/usr/bin/python
 import argparse
+import bisect
 import boto
+import contextlib
 import json
 import datetime
+import fcntl
+import os
 import time
+# Only what send needs, or boto loads anyway, is imported up front. sqlite3,
+# mmap and the dynamodb, sns and thread pool modules are imported where they
+# are used to keep send starting fast.
+from boto.sqs.batchresults import BatchResults
 from boto.sqs.message import RawMessage
-from boto.dynamodb2.table import Table
-from boto.dynamodb2.fields import HashKey
-from boto.dynamodb2.fields import RangeKey
+from boto.sqs.queue import Queue
 import pprint
+import signal
+import socket
+import struct
 import sys
+import tempfile
+import threading
+import zlib
 
 MEMON_VERSION = '0.0.1'
 
@@ -21,6 +33,7 @@ class Notification:
 class PeriodType:
     Fixed = 'fixed'
     Rolling = 'rolling'
+    Cron = 'cron'
 
 
 class Schema:
@@ -33,28 +46,1753 @@ class Schema:
     LastBlockTime = 'LastBlockTime'
     NextBlockTime = 'NextBlockTime'
     LastSuccessTime = 'LastSuccessTime'
+    NotifyTime = 'NotifyTime'
+    Version = 'Version'
+    Schedule = 'Schedule'
+
+
+class DueSchema:
+    Bucket = 'Bucket'
+    Due = 'Due'
+    Name = 'Name'
+
+
+class LeaseSchema:
+    # Rows are 'shard:N' leases and 'poller:ID' heartbeats
+    Name = 'Name'
+    Owner = 'Owner'
+    Expires = 'Expires'
+
+
+def name_hash(name):
+    # Stable hash of an event name, whether it's str or unicode
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return zlib.crc32(name) & 0xffffffff
+
+
+class Schedule(object):
+    # Works out when an event is next expected. Each subclass defines
+    # advance(last_block, event_time), returning the (LastBlockTime,
+    # NextBlockTime) for a run at event_time, in O(1) for fixed and rolling
+    # periods.
+
+    def __init__(self, period):
+        self.period = int(period)
+
+    def first(self, start):
+        # NextBlockTime for an event (re)scheduled to start at start
+        return start
+
+    @staticmethod
+    def for_event(event):
+        # None for an unknown type, which is a config error
+        if event[Schema.Type] == PeriodType.Rolling:
+            return RollingSchedule(event[Schema.Period])
+        elif event[Schema.Type] == PeriodType.Fixed:
+            return FixedSchedule(event[Schema.Period])
+        elif event[Schema.Type] == PeriodType.Cron:
+            return CronSchedule.parse(event[Schema.Schedule],
+                                      event[Schema.Period])
+        return None
+
+
+class RollingSchedule(Schedule):
+
+    def advance(self, last_block, event_time):
+        return event_time, event_time + self.period
+
+
+class FixedSchedule(Schedule):
+
+    def advance(self, last_block, event_time):
+        # Smallest whole number of periods (at least one) past last_block
+        # that covers event_time
+        periods = max(1, -(-(event_time - last_block) // self.period))
+        last_block += self.period * periods
+        return last_block, last_block + self.period
+
+
+class CronSchedule(Schedule):
+    # 'minute hour day-of-month month day-of-week' in local time, with the
+    # usual *, ranges, lists and steps. Each field is expanded once into a
+    # sorted list so the next fire time can jump straight to the next
+    # matching month, day, hour and minute.
+
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+    NAMES = [
+        {},
+        {},
+        {},
+        dict((name, i + 1) for i, name in enumerate(
+            ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+             'jul', 'aug', 'sep', 'oct', 'nov', 'dec'])),
+        dict((name, i) for i, name in enumerate(
+            ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'])),
+    ]
+    parsed = {}
+
+    def __init__(self, expression, period=60):
+        Schedule.__init__(self, period)
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Cron schedule needs 5 fields: %s' %
+                             (expression))
+        values = [self.parse_field(field, bounds, names)
+                  for field, bounds, names in zip(fields, self.FIELDS,
+                                                  self.NAMES)]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        # 7 is also sunday
+        self.weekdays = sorted(set(day % 7 for day in weekdays))
+        # Like cron, if both day fields are restricted either may match
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+        self.expression = expression
+
+    @classmethod
+    def parse(cls, expression, period=60):
+        key = (expression, int(period))
+        if key not in cls.parsed:
+            cls.parsed[key] = cls(expression, period)
+        return cls.parsed[key]
+
+    @staticmethod
+    def parse_field(field, bounds, names):
+        low, high = bounds
+        values = set()
+        for part in field.lower().split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+                if step < 1:
+                    raise ValueError('Invalid cron step: %s' % (field))
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(names.get(value, value))
+                              for value in part.split('-', 1)]
+            else:
+                start = int(names.get(part, part))
+                end = high if step > 1 else start
+            if start < low or end > high or start > end:
+                raise ValueError('Invalid cron field: %s' % (field))
+            values.update(xrange(start, end + 1, step))
+        return sorted(values)
+
+    def day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next_fire(self, start):
+        # First fire time at or after start
+        dt = datetime.datetime.fromtimestamp(start)
+        if dt.second or dt.microsecond:
+            dt = (dt.replace(second=0, microsecond=0) +
+                  datetime.timedelta(minutes=1))
+        # Bounded, as a schedule like 29 Feb only fires every 4 years
+        limit = dt + datetime.timedelta(days=366 * 8)
+        while dt < limit:
+            if dt.month not in self.months:
+                i = bisect.bisect_left(self.months, dt.month)
+                if i < len(self.months):
+                    dt = dt.replace(month=self.months[i], day=1, hour=0,
+                                    minute=0)
+                else:
+                    dt = dt.replace(year=dt.year + 1, month=self.months[0],
+                                    day=1, hour=0, minute=0)
+                continue
+            if not self.day_matches(dt):
+                dt = (dt.replace(hour=0, minute=0) +
+                      datetime.timedelta(days=1))
+                continue
+            if dt.hour not in self.hours:
+                i = bisect.bisect_left(self.hours, dt.hour)
+                if i < len(self.hours):
+                    dt = dt.replace(hour=self.hours[i], minute=0)
+                else:
+                    dt = (dt.replace(hour=0, minute=0) +
+                          datetime.timedelta(days=1))
+                continue
+            if dt.minute not in self.minutes:
+                i = bisect.bisect_left(self.minutes, dt.minute)
+                if i < len(self.minutes):
+                    dt = dt.replace(minute=self.minutes[i])
+                else:
+                    dt = (dt.replace(minute=0) +
+                          datetime.timedelta(hours=1))
+                continue
+            return int(time.mktime(dt.timetuple()))
+        raise ValueError('Cron schedule never fires: %s' % (self.expression))
+
+    def first(self, start):
+        return self.next_fire(start)
+
+    def advance(self, last_block, event_time):
+        # Like fixed periods, the run covers the first fire time at or after
+        # it and the next run is expected by the fire time after that
+        last_block = self.next_fire(event_time)
+        return last_block, self.next_fire(last_block + 60)
+
+
+class EventCache(object):
+    # Local SQLite snapshot of the event table. Each event is stored with
+    # the Version it was last seen at and its NotifyTime so down events can
+    # be found with an indexed query.
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS events ('
+                              'name TEXT PRIMARY KEY, version INTEGER, '
+                              'notify_time INTEGER, data TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS events_notify_time '
+                              'ON events (notify_time)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                              'key TEXT PRIMARY KEY, value INTEGER)')
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared between record workers
+        if not hasattr(self.local, 'conn'):
+            import sqlite3
+            self.local.conn = sqlite3.connect(self.path)
+        return self.local.conn
+
+    def get(self, name):
+        row = self.conn.execute('SELECT data FROM events WHERE name = ?',
+                                (name,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def due(self, now):
+        return [json.loads(row[0]) for row in self.conn.execute(
+            'SELECT data FROM events WHERE notify_time <= ? ORDER BY name',
+            (now,))]
+
+    def versions(self):
+        return dict(self.conn.execute('SELECT name, version FROM events'))
+
+    def put(self, event, notify_time):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO events '
+                              '(name, version, notify_time, data) '
+                              'VALUES (?, ?, ?, ?)',
+                              (event[Schema.Name],
+                               event.get(Schema.Version),
+                               notify_time,
+                               json.dumps(dict(event))))
+
+    def delete(self, name):
+        with self.conn:
+            self.conn.execute('DELETE FROM events WHERE name = ?', (name,))
+
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_meta(self, key, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) '
+                              'VALUES (?, ?)', (key, value))
+
+
+class TokenBucket(object):
+    # Allows rate tokens a second on average, in bursts of up to burst
+
+    def __init__(self, rate, burst, tokens=None, updated=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens=1, now=None):
+        self.refill(time.time() if now is None else now)
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def borrow(self, tokens, now=None):
+        # Takes tokens even if that leaves the bucket in debt, returning the
+        # seconds to wait until the debt is paid off
+        self.refill(time.time() if now is None else now)
+        self.tokens -= tokens
+        return max(0.0, -self.tokens / self.rate)
+
+    def state(self):
+        return {'tokens': self.tokens, 'updated': self.updated}
+
+
+class Outbox(object):
+    # Durable local queue of notifications waiting to be published to SNS.
+    # Rows are only deleted once published, so alerts survive a crash.
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                              'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                              'topic TEXT, subject TEXT, message TEXT, '
+                              'created INTEGER, attempts INTEGER, '
+                              'next_attempt INTEGER)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS '
+                              'outbox_next_attempt ON outbox (next_attempt)')
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared between threads
+        if not hasattr(self.local, 'conn'):
+            import sqlite3
+            self.local.conn = sqlite3.connect(self.path)
+        return self.local.conn
+
+    def append(self, topic, subject, message, now):
+        with self.conn:
+            self.conn.execute('INSERT INTO outbox (topic, subject, message, '
+                              'created, attempts, next_attempt) '
+                              'VALUES (?, ?, ?, ?, 0, ?)',
+                              (topic, subject, message, now, now))
+
+    def pending(self, now, limit):
+        return self.conn.execute('SELECT id, topic, subject, message, '
+                                 'created, attempts FROM outbox '
+                                 'WHERE next_attempt <= ? ORDER BY id '
+                                 'LIMIT ?', (now, limit)).fetchall()
+
+    def delivered(self, row_id):
+        with self.conn:
+            self.conn.execute('DELETE FROM outbox WHERE id = ?', (row_id,))
+
+    def retry(self, row_id, attempts, next_attempt):
+        with self.conn:
+            self.conn.execute('UPDATE outbox SET attempts = ?, '
+                              'next_attempt = ? WHERE id = ?',
+                              (attempts, next_attempt, row_id))
+
+    def depth(self):
+        # (pending notifications, creation time of the oldest)
+        return self.conn.execute('SELECT COUNT(*), MIN(created) '
+                                 'FROM outbox').fetchone()
+
+
+class OutboxDrainer(threading.Thread):
+    # Publishes from the outbox while the poll runs, so SNS latency doesn't
+    # hold up recording heartbeats or checking for down events
+
+    def __init__(self, memon, interval=1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.memon = memon
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while True:
+            stopping = self.stopping.is_set()
+            try:
+                attempted = self.memon.drain_outbox()
+            except Exception as e:
+                print e
+                attempted = 0
+            if not attempted:
+                if stopping:
+                    return
+                self.stopping.wait(self.interval)
+
+    def stop(self, timeout):
+        # Anything left once timeout expires stays in the outbox for the
+        # next run
+        self.stopping.set()
+        self.join(timeout)
+
+
+class ResourceCache(object):
+    # Topic arns, queue urls and table descriptions persisted between runs,
+    # so short lived cron invocations can skip the control plane lookups
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.resources = {}
+        try:
+            with open(path) as f:
+                self.resources = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def get(self, key):
+        resource = self.resources.get(key)
+        if resource is None or time.time() - resource['time'] >= self.ttl:
+            return None
+        return resource['value']
+
+    def set(self, key, value):
+        self.resources[key] = {'time': int(time.time()), 'value': value}
+        self.save()
+
+    def invalidate(self, key=None):
+        if key is None:
+            found = bool(self.resources)
+            self.resources = {}
+        else:
+            found = self.resources.pop(key, None) is not None
+        if found:
+            self.save()
+        return found
+
+    def save(self):
+        # Best effort, an unwritable cache only means looking everything up
+        # again next run. Written to a temp file of its own then renamed, so
+        # concurrent runs and threads never see or write a partial file.
+        directory = os.path.dirname(self.path)
+        tmp = None
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            handle, tmp = tempfile.mkstemp(dir=directory or '.',
+                                           prefix=os.path.basename(self.path))
+            with os.fdopen(handle, 'w') as f:
+                json.dump(dict(self.resources), f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            # quietly, as cron mails anything send prints
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class Metrics(object):
+    # Counts and latencies for one poll cycle, written after the cycle as a
+    # prometheus textfile (for node_exporter's textfile collector) or
+    # appended as a json line
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60, 300, 900, 3600)
+    types = {
+        'memon_cycle_timestamp_seconds': (
+            'gauge', 'When the last poll cycle ran'),
+        'memon_cycle_failed': (
+            'gauge', '1 if the last poll cycle raised an error'),
+        'memon_cycle_seconds': (
+            'gauge', 'Time spent in each phase of the last poll cycle'),
+        'memon_messages_received': (
+            'gauge', 'SQS messages received in the last poll cycle'),
+        'memon_queue_backlog': (
+            'gauge', 'Approximate messages left in SQS after polling'),
+        'memon_messages_deleted': (
+            'gauge', 'SQS messages deleted in the last poll cycle'),
+        'memon_delete_failures': (
+            'gauge', 'SQS messages that failed to delete in the last cycle'),
+        'memon_heartbeat_lag_seconds': (
+            'histogram', 'Time between a heartbeat being sent and polled'),
+        'memon_events_recorded': (
+            'gauge', 'Events updated by heartbeats in the last poll cycle'),
+        'memon_down_events': (
+            'gauge', 'Events found overdue in the last poll cycle'),
+        'memon_notifications': (
+            'gauge', 'Notifications raised in the last poll cycle'),
+        'memon_published': (
+            'gauge', 'Messages published or queued for SNS in the last cycle'),
+        'memon_aws_request_seconds': (
+            'histogram', 'Latency of AWS requests'),
+        'memon_aws_errors': (
+            'gauge', 'AWS requests that failed in the last poll cycle'),
+        'memon_throttle_retries': (
+            'gauge', 'Throttled requests boto retried in the last cycle'),
+        'memon_owned_shards': (
+            'gauge', 'Shards this poller checks for down events'),
+        'memon_unprocessed_retries': (
+            'gauge', 'BatchWriteItem calls retrying unprocessed items'),
+        'memon_consumed_capacity': (
+            'gauge', 'DynamoDB capacity units consumed in the last cycle'),
+        'memon_capacity_wait_seconds': (
+            'gauge', 'Time spent pacing DynamoDB requests in the last cycle'),
+        'memon_capacity_short': (
+            'gauge', '1 if a table needed more than its provisioned capacity'),
+        'memon_throttled_events': (
+            'gauge', 'Heartbeats and down checks put off by throttling'),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.values = {}
+        self.histograms = {}
+
+    def key(self, name, labels):
+        assert name in self.types, name
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, **labels):
+        # histograms are kept as [count per bucket..., +Inf count, sum]
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, [0] * (len(self.buckets) + 1) + [0])
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.set(name, time.time() - start, **labels)
+
+    def instrument(self, conn, service):
+        # Times every request made on a boto connection, and counts the
+        # throttling retries dynamodb makes inside the request
+        make_request = getattr(conn, 'make_request', None)
+        if make_request is None or getattr(conn, 'instrumented', False):
+            return conn
+        metrics = self
+
+        def timed_request(action, *args, **kwargs):
+            start = time.time()
+            throttled = getattr(conn, 'throughput_exceeded_events', 0)
+            try:
+                return make_request(action, *args, **kwargs)
+            except boto.exception.BotoServerError:
+                metrics.inc('memon_aws_errors', service=service,
+                            action=action)
+                raise
+            finally:
+                metrics.observe('memon_aws_request_seconds',
+                                time.time() - start, service=service,
+                                action=action)
+                throttled = (getattr(conn, 'throughput_exceeded_events', 0) -
+                             throttled)
+                if throttled:
+                    metrics.inc('memon_throttle_retries', throttled,
+                                service=service)
+        conn.make_request = timed_request
+        conn.instrumented = True
+        return conn
+
+    def labels(self, labels, extra=()):
+        labels = labels + tuple(extra)
+        if not labels:
+            return ''
+        return '{%s}' % (','.join('%s="%s"' % (name, value)
+                                  for name, value in labels))
+
+    def samples(self):
+        # (name, text) of each sample, histograms expanded prometheus style
+        samples = []
+        for (name, labels), value in self.values.items():
+            samples.append((name, '%s%s %s' % (name, self.labels(labels),
+                                               value)))
+        for (name, labels), histogram in self.histograms.items():
+            total = 0
+            for i, le in enumerate(self.buckets + ('+Inf',)):
+                total += histogram[i]
+                samples.append((name, '%s_bucket%s %d' % (
+                    name, self.labels(labels, [('le', le)]), total)))
+            samples.append((name, '%s_sum%s %s' % (
+                name, self.labels(labels), histogram[-1])))
+            samples.append((name, '%s_count%s %d' % (
+                name, self.labels(labels), total)))
+        return samples
+
+    def prometheus(self):
+        lines = []
+        samples = self.samples()
+        for name in sorted(set(name for name, sample in samples)):
+            lines.append('# HELP %s %s' % (name, self.types[name][1]))
+            lines.append('# TYPE %s %s' % (name, self.types[name][0]))
+            lines.extend(sorted(sample for sample_name, sample in samples
+                                if sample_name == name))
+        return '\n'.join(lines) + '\n'
+
+    def json(self):
+        metrics = {}
+        for (name, labels), value in self.values.items():
+            metrics[name + self.labels(labels)] = value
+        for (name, labels), histogram in self.histograms.items():
+            metrics[name + self.labels(labels)] = {
+                'count': sum(histogram[:-1]),
+                'sum': histogram[-1],
+                'buckets': dict(zip([str(le) for le in self.buckets] +
+                                    ['+Inf'], histogram[:-1])),
+            }
+        return metrics
+
+    def write(self, path, format):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if format == 'json':
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.json(), sort_keys=True) + '\n')
+            return
+        # write then rename so the collector never reads a partial file
+        tmp = '%s.%d' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.rename(tmp, path)
+
+
+class CapacityLimiter(object):
+    # Accounts for the capacity units each DynamoDB response reports and
+    # paces requests to each table's provisioned capacity: the units are
+    # taken from a bucket refilled at the provisioned rate, holding up to
+    # burst seconds of it, and the request that overdraws it sleeps off the
+    # debt. Shared by every connection and thread.
+
+    reads = ('GetItem', 'BatchGetItem', 'Query', 'Scan')
+
+    def __init__(self, metrics, burst=60):
+        self.metrics = metrics
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.reset()
+
+    def reset(self):
+        self.waited = {}
+
+    def provision(self, table, read_units, write_units):
+        # on demand tables have no provisioned units to pace to
+        for kind, units in (('read', read_units), ('write', write_units)):
+            if units and self.burst:
+                self.buckets[(table, kind)] = TokenBucket(units,
+                                                          units * self.burst)
+
+    def consumed(self, body, response):
+        # (table, units) for each table a response from either dynamodb API
+        # version reports capacity for
+        if not isinstance(response, dict):
+            return []
+        if 'ConsumedCapacityUnits' in response:
+            return [(json.loads(body).get('TableName'),
+                     response['ConsumedCapacityUnits'])]
+        consumed = response.get('ConsumedCapacity')
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+        if consumed:
+            return [(item.get('TableName'), item.get('CapacityUnits', 0))
+                    for item in consumed]
+        return [(table, result['ConsumedCapacityUnits'])
+                for table, result in response.get('Responses', {}).items()
+                if isinstance(result, dict) and
+                'ConsumedCapacityUnits' in result]
+
+    def consume(self, table, kind, units):
+        self.metrics.inc('memon_consumed_capacity', units, table=table,
+                         kind=kind)
+        bucket = self.buckets.get((table, kind))
+        if bucket is None:
+            return
+        with self.lock:
+            wait = bucket.borrow(units)
+            if wait:
+                self.waited[(table, kind)] = (
+                    self.waited.get((table, kind), 0) + wait)
+        time.sleep(wait)
+
+    def throttled(self, body, action):
+        # The table can't take even what we've paced it to right now, so
+        # whatever is left in its bucket can't be relied on
+        table = json.loads(body).get('TableName') if body else None
+        kind = 'read' if action in self.reads else 'write'
+        bucket = self.buckets.get((table, kind))
+        if bucket is not None:
+            with self.lock:
+                bucket.tokens = min(bucket.tokens, 0)
+
+    def install(self, conn):
+        make_request = getattr(conn, 'make_request', None)
+        if make_request is None or getattr(conn, 'capacity_limited', False):
+            return conn
+        limiter = self
+
+        def limited_request(action, body='', *args, **kwargs):
+            throttled = getattr(conn, 'throughput_exceeded_events', 0)
+            try:
+                response = make_request(action, body, *args, **kwargs)
+            finally:
+                if getattr(conn, 'throughput_exceeded_events', 0) > throttled:
+                    limiter.throttled(body, action)
+            kind = 'read' if action in limiter.reads else 'write'
+            for table, units in limiter.consumed(body, response):
+                limiter.consume(table, kind, units)
+            return response
+        conn.make_request = limited_request
+        conn.capacity_limited = True
+        return conn
+
+
+class Spool(object):
+    # Heartbeats appended on the host by send, shipped to sqs in packed
+    # batches by flush. Flush moves the file aside and holds a lock on it
+    # until it has been sent, so a failed flush is picked up next time.
+
+    def __init__(self, path):
+        self.path = path
+        self.flush_path = path + '.flush'
+        self.flushing = None
+
+    def append(self, msg):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        while True:
+            f = open(self.path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # flush may have moved the file while we waited for the lock
+                try:
+                    current = os.stat(self.path).st_ino
+                except OSError:
+                    current = None
+                if current == os.fstat(f.fileno()).st_ino:
+                    f.write(json.dumps(msg) + '\n')
+                    return
+            finally:
+                f.close()
+
+    def take(self):
+        # Returns the heartbeats to send, or None if there's nothing to
+        # flush or another flush is already sending them
+        if not os.path.exists(self.flush_path):
+            try:
+                os.rename(self.path, self.flush_path)
+            except OSError:
+                return None
+        try:
+            f = open(self.flush_path)
+        except IOError:
+            return None
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return None
+        self.flushing = f
+        msgs = []
+        for line in f:
+            try:
+                msgs.append(json.loads(line))
+            except ValueError:
+                # a partial line from a send that died mid write
+                pass
+        return msgs
+
+    def done(self):
+        os.remove(self.flush_path)
+        self.release()
+
+    def release(self):
+        if self.flushing:
+            self.flushing.close()
+            self.flushing = None
+
+
+class History(object):
+    # Append-only log of processed heartbeats and notifications. Each UTC day
+    # is a file of fixed width records, appended a batch at a time, so reads
+    # memory map the file and scan it, and expiring history is deleting whole
+    # days. Names are stored as their crc32, with each name written once to
+    # the names file.
+
+    # recorded, name crc32, event time, kind
+    record = struct.Struct('<IIIB')
+    # notifications are stored as their Notification, which never uses 0
+    Heartbeat = 0
+    day_seconds = 86400
+
+    def __init__(self, path, retention=90):
+        self.path = path
+        self.retention = retention
+        self.names_path = os.path.join(path, 'names')
+        self.names = {}
+        self.pending = []
+        self.rollups = None
+
+    def key(self, name):
+        return name_hash(name)
+
+    def day_path(self, recorded):
+        return os.path.join(self.path, time.strftime(
+            '%Y-%m-%d.hist', time.gmtime(recorded)))
+
+    def add(self, recorded, name, kind, event_time=None):
+        # Kept until the next write, safe to call from record workers
+        self.pending.append((recorded, name, kind,
+                             recorded if event_time is None else event_time))
+
+    def write(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.load_names()
+        names = {}
+        days = {}
+        for recorded, name, kind, event_time in sorted(
+                pending, key=lambda record: record[0]):
+            key = self.key(name)
+            if self.names.get(key) != name:
+                names[key] = name
+            days.setdefault(self.day_path(recorded), []).append(
+                self.record.pack(recorded, key, event_time, kind))
+        if names:
+            with open(self.names_path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                for key, name in sorted(names.items()):
+                    f.write('%08x %s\n' % (key, name.encode('utf-8')))
+            self.names.update(names)
+        # one write per day while holding the lock, so records from other
+        # pollers are never interleaved
+        for path, records in sorted(days.items()):
+            with open(path, 'ab') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(''.join(records))
+        self.get_rollups().update(sorted(pending, key=lambda r: r[0]))
+        return len(pending)
+
+    def get_rollups(self):
+        if self.rollups is None:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self.rollups = Rollups(os.path.join(self.path, 'rollups.db'))
+        return self.rollups
+
+    def load_names(self):
+        try:
+            with open(self.names_path) as f:
+                for line in f:
+                    key, name = line.rstrip('\n').split(' ', 1)
+                    self.names[int(key, 16)] = name.decode('utf-8')
+        except IOError:
+            pass
+        return self.names
+
+    def expire(self, now):
+        # Deletes the days older than retention days
+        if not os.path.isdir(self.path):
+            return
+        oldest = os.path.basename(
+            self.day_path(now - self.retention * self.day_seconds))
+        for filename in os.listdir(self.path):
+            if filename.endswith('.hist') and filename < oldest:
+                os.remove(os.path.join(self.path, filename))
+        self.get_rollups().expire(now,
+                                  now - self.retention * self.day_seconds)
+
+    def read(self, start, end, name=None):
+        # Yields (recorded, name, kind, event time) for everything recorded
+        # from start up to end, for one name or all of them
+        import mmap
+
+        self.load_names()
+        key = None if name is None else self.key(name)
+        day = start - start % self.day_seconds
+        while day < end:
+            try:
+                f = open(self.day_path(day), 'rb')
+            except IOError:
+                day += self.day_seconds
+                continue
+            with f:
+                count = os.fstat(f.fileno()).st_size // self.record.size
+                if count:
+                    m = mmap.mmap(f.fileno(), count * self.record.size,
+                                  access=mmap.ACCESS_READ)
+                    # each batch is in order, but pollers sharing the
+                    # directory interleave theirs, so the whole day is read
+                    # and sorted rather than searched
+                    try:
+                        records = []
+                        for i in xrange(count):
+                            record = self.record.unpack_from(
+                                m, i * self.record.size)
+                            if (start <= record[0] < end and
+                                    (key is None or record[1] == key)):
+                                records.append(record)
+                    finally:
+                        m.close()
+                    records.sort(key=lambda record: record[0])
+                    for recorded, record_key, event_time, kind in records:
+                        yield (recorded,
+                               self.names.get(record_key,
+                                              '%08x' % (record_key)),
+                               kind, event_time)
+            day += self.day_seconds
+
+
+class Rollups(object):
+    # Hourly and daily counters for each event, updated from each batch of
+    # history as it's written, so reports sum a few rows per event instead
+    # of reading the raw history. state holds what carries over between
+    # batches: the last run and when an event that's still down went down.
+
+    periods = (3600, 86400)
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS rollups ('
+                              'name TEXT, period INTEGER, start INTEGER, '
+                              'runs INTEGER DEFAULT 0, '
+                              'failures INTEGER DEFAULT 0, '
+                              'max_gap INTEGER DEFAULT 0, '
+                              'last_failure INTEGER DEFAULT 0, '
+                              'down_seconds INTEGER DEFAULT 0, '
+                              'PRIMARY KEY (period, start, name))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS state ('
+                              'name TEXT PRIMARY KEY, last_run INTEGER, '
+                              'down_since INTEGER)')
+
+    def add(self, name, when, runs=0, failures=0, max_gap=0,
+            last_failure=0, down_seconds=0):
+        for period in self.periods:
+            start = when - when % period
+            self.conn.execute('INSERT OR IGNORE INTO rollups (name, period, '
+                              'start) VALUES (?, ?, ?)', (name, period, start))
+            self.conn.execute('UPDATE rollups SET runs = runs + ?, '
+                              'failures = failures + ?, '
+                              'max_gap = MAX(max_gap, ?), '
+                              'last_failure = MAX(last_failure, ?), '
+                              'down_seconds = down_seconds + ? '
+                              'WHERE period = ? AND start = ? AND name = ?',
+                              (runs, failures, max_gap, last_failure,
+                               down_seconds, period, start, name))
+
+    def add_down(self, name, since, until):
+        # Split across the hours it covers, which the days add up
+        while since < until:
+            end = min(until, since - since % self.periods[0] +
+                      self.periods[0])
+            self.add(name, since, down_seconds=end - since)
+            since = end
+
+    def update(self, records):
+        states = {}
+        with self.conn:
+            for recorded, name, kind, event_time in records:
+                if name not in states:
+                    states[name] = self.conn.execute(
+                        'SELECT last_run, down_since FROM state '
+                        'WHERE name = ?', (name,)).fetchone() or (None, None)
+                last_run, down_since = states[name]
+                if kind == History.Heartbeat:
+                    gap = 0
+                    if last_run is not None and event_time > last_run:
+                        gap = event_time - last_run
+                    self.add(name, event_time, runs=1, max_gap=gap)
+                    if last_run is None or event_time > last_run:
+                        last_run = event_time
+                    # recording a heartbeat always clears ErrorCount, so it
+                    # ends a failure even when no Up was sent for it
+                    if down_since is not None:
+                        self.add_down(name, down_since, recorded)
+                        down_since = None
+                elif kind == Notification.Down and down_since is None:
+                    # only going down (ErrorCount reaching 1) is a failure,
+                    # the repeat Down notifications are the same one
+                    self.add(name, recorded, failures=1,
+                             last_failure=recorded)
+                    down_since = recorded
+                elif kind == Notification.Up and down_since is not None:
+                    self.add_down(name, down_since, recorded)
+                    down_since = None
+                states[name] = (last_run, down_since)
+            self.conn.executemany('INSERT OR REPLACE INTO state (name, '
+                                  'last_run, down_since) VALUES (?, ?, ?)',
+                                  [(name, last_run, down_since)
+                                   for name, (last_run, down_since)
+                                   in states.items()])
+
+    def expire(self, now, oldest):
+        # Hours are only kept for reports over the last day
+        with self.conn:
+            self.conn.execute('DELETE FROM rollups WHERE period = ? AND '
+                              'start < ?', (self.periods[0],
+                                            now - 2 * self.periods[1]))
+            self.conn.execute('DELETE FROM rollups WHERE start < ?',
+                              (oldest - oldest % self.periods[1],))
+
+    def report(self, since, now, name=None):
+        # Per event totals from since (rounded down to the hour, or the day
+        # for more than a day) until now. The sums are done by sqlite over
+        # every event at once, rather than row by row here.
+        period = self.periods[0 if now - since <= self.periods[1] else 1]
+        since -= since % period
+        totals = {}
+        for row in self.conn.execute('SELECT name, SUM(runs), '
+                                     'SUM(failures), MAX(max_gap), '
+                                     'MAX(last_failure), SUM(down_seconds) '
+                                     'FROM rollups WHERE period = ? AND '
+                                     'start >= ? AND (name = ? OR ? IS NULL) '
+                                     'GROUP BY name',
+                                     (period, since, name, name)):
+            totals[row[0]] = list(row[1:])
+        report = []
+        for event, last_run, down_since in self.conn.execute(
+                'SELECT name, last_run, down_since FROM state '
+                'WHERE name = ? OR ? IS NULL', (name, name)):
+            runs, failures, max_gap, last_failure, down_seconds = \
+                totals.pop(event, [0, 0, 0, 0, 0])
+            # still running late or down, up to now
+            if last_run is not None:
+                max_gap = max(max_gap, now - last_run)
+            if down_since is not None:
+                down_seconds += now - max(down_since, since)
+            report.append({
+                'name': event,
+                'runs': runs,
+                'failures': failures,
+                'longest_gap': max_gap,
+                'last_failure': last_failure or None,
+                'availability': max(0.0, 1 - down_seconds /
+                                    float(now - since)),
+            })
+        return sorted(report, key=lambda row: row['name'])
+
+
+class Agent(object):
+    # Local heartbeat listener so jobs can signal with a udp datagram or a
+    # localhost http request instead of running send. Only the newest time
+    # per name is kept and forwarded to sqs every flush interval.
+
+    def __init__(self, memon):
+        self.memon = memon
+        self.events = {}
+        self.lock = threading.Lock()
+        self.servers = []
+
+    def add(self, name, event_time=None):
+        name = name.strip()
+        if not name:
+            return
+        if event_time is None:
+            event_time = int(time.time())
+        with self.lock:
+            if event_time > self.events.get(name, 0):
+                self.events[name] = event_time
+
+    def listen_udp(self, address):
+        # One event name per line, several lines may share a datagram
+        import SocketServer
+
+        agent = self
+
+        class Handler(SocketServer.BaseRequestHandler):
+            def handle(self):
+                for name in self.request[0].splitlines():
+                    agent.add(name)
+
+        return self.serve(SocketServer.UDPServer(address, Handler))
+
+    def listen_http(self, address):
+        # POST /NAME
+        import BaseHTTPServer
+        import urllib
+
+        agent = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                name = urllib.unquote(self.path.lstrip('/'))
+                if not name:
+                    self.send_error(400, 'Missing event name')
+                    return
+                agent.add(name)
+                self.send_response(204)
+                self.end_headers()
+
+            do_PUT = do_POST
+
+            def log_message(self, *args):
+                if agent.memon.debug:
+                    BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                        self, *args)
+
+        return self.serve(BaseHTTPServer.HTTPServer(address, Handler))
+
+    def serve(self, server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return server
+
+    def flush(self):
+        # Returns the number of events forwarded
+        with self.lock:
+            events, self.events = self.events, {}
+        if not events:
+            return 0
+        try:
+            self.memon.send_events(events)
+        except Exception:
+            # keep them for the next flush unless newer ones arrived
+            for name, event_time in events.items():
+                self.add(name, event_time)
+            raise
+        return len(events)
+
+    def run(self, interval):
+        while not self.memon.stopping.wait(interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print e
+        self.shutdown()
+        self.flush()
+
+    def shutdown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+
+class AwsBackend(object):
+    # The default backend: events in DynamoDB, heartbeats on SQS and
+    # notifications on SNS. MEMon owns the connections and the resource
+    # cache, so the backend works through it.
+
+    def __init__(self, memon):
+        self.memon = memon
+
+    def init(self):
+        self.memon.aws_init()
+
+    def table(self, name):
+        memon = self.memon
+        key = memon.resource_key('table', name)
+        description = None
+        if memon.resources:
+            description = memon.resources.get(key)
+        if description is None:
+            description = memon.db.describe_table(name)
+            if memon.resources:
+                memon.resources.set(key, description)
+        from boto.dynamodb.table import Table
+        table = Table(memon.db, description)
+        memon.capacity.provision(table.name, table.read_units,
+                                 table.write_units)
+        return table
+
+    def due_table(self, name):
+        try:
+            return self.table(name)
+        except boto.exception.DynamoDBResponseError as e:
+            # Fall back to scanning for down events without the index
+            if self.memon.debug:
+                print e
+        return None
+
+    def queue(self, name):
+        memon = self.memon
+        key = memon.resource_key('queue', name)
+        if memon.resources:
+            url = memon.resources.get(key)
+            if url:
+                return Queue(memon.sqs, url)
+
+        q = memon.sqs.get_queue(name)
+        if q is None:
+            raise Exception('Unable to locate queue %s' % (name))
+        if memon.resources:
+            memon.resources.set(key, q.url)
+        return q
+
+    def topic_arn(self, name):
+        memon = self.memon
+        key = memon.resource_key('topic', name)
+        if memon.resources:
+            arn = memon.resources.get(key)
+            if arn:
+                return arn
+
+        next_token = None
+        while True:
+            all_topics = memon.sns_conn.get_all_topics(next_token)
+            result = all_topics['ListTopicsResponse']['ListTopicsResult']
+            for topic in result['Topics']:
+                if topic['TopicArn'].endswith(':' + name):
+                    if memon.resources:
+                        memon.resources.set(key, topic['TopicArn'])
+                    return topic['TopicArn']
+            next_token = result['NextToken']
+            if not next_token:
+                break
+
+        raise Exception('Unable to locate topic arn for %s' % (name))
+
+    def publisher(self):
+        # A new connection, boto connections aren't thread safe
+        import boto.sns
+
+        return self.memon.metrics.instrument(
+            boto.sns.connect_to_region(self.memon.region), 'sns')
+
+    def down_events(self, table, now):
+        memon = self.memon
+        if memon.due_table:
+            return memon.due_events()
+        return memon.scan_events()
+
+    def reindex(self):
+        memon = self.memon
+        if not memon.due_table:
+            raise Exception('Missing due index table %s' %
+                            (memon.due_table_name))
+        deletes = [(memon.due_table,
+                    (row[DueSchema.Bucket], row[DueSchema.Due]))
+                   for row in memon.due_table.scan()]
+        self.batch_write([], deletes)
+
+    def scan_segment(self, table, segment, total_segments, scan_filter=None,
+                     attributes_to_get=None):
+        # Parallel scans need the 2012-08-10 API, and boto connections aren't
+        # thread safe so each scan worker keeps its own connection
+        memon = self.memon
+        conn = getattr(memon.local, 'dynamodb2', None)
+        if conn is None:
+            import boto.dynamodb2
+            conn = boto.dynamodb2.connect_to_region(memon.region)
+            memon.metrics.instrument(conn, 'dynamodb')
+            memon.capacity.install(conn)
+            memon.local.dynamodb2 = conn
+        dynamizer = table.layer2.dynamizer
+        kwargs = {'segment': segment,
+                  'total_segments': total_segments,
+                  'return_consumed_capacity': 'TOTAL'}
+        if scan_filter:
+            kwargs['scan_filter'] = dict((attr, condition.to_dict())
+                                         for attr, condition
+                                         in scan_filter.items())
+        if attributes_to_get:
+            kwargs['attributes_to_get'] = attributes_to_get
+        while True:
+            response = conn.scan(table.name, **kwargs)
+            page = [dict((attr, dynamizer.decode(value))
+                         for attr, value in item.items())
+                    for item in response.get('Items', [])]
+            yield page, response.get('ConsumedCapacity', {}).get(
+                'CapacityUnits', 0)
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['exclusive_start_key'] = response['LastEvaluatedKey']
+
+    def init_record_worker(self):
+        # boto connections aren't thread safe, so each worker gets its own
+        # connection and copies of the tables
+        import boto.dynamodb
+        from boto.dynamodb.table import Table
+
+        memon = self.memon
+        db = boto.dynamodb.connect_to_region(memon.region)
+        memon.metrics.instrument(db.layer1, 'dynamodb')
+        memon.capacity.install(db.layer1)
+        # the schemas are already known, so there's no need to describe
+        # the tables again
+        memon.local.table = Table.create_from_schema(
+            db, memon._table.name, memon._table.schema)
+        if memon._due_table is not None:
+            memon.local.due_table = Table.create_from_schema(
+                db, memon._due_table.name, memon._due_table.schema)
+
+    def batch_write(self, puts, deletes, max_attempts=5):
+        # puts are items, deletes are (table, key) pairs. BatchWriteItem
+        # accepts at most 25 requests per call, across all tables.
+        memon = self.memon
+        requests = ([(item.table, item, None) for item in puts] +
+                    [(table, None, key) for table, key in deletes])
+        for i in xrange(0, len(requests), 25):
+            tables = {}
+            for table, item, key in requests[i:i + 25]:
+                batch = tables.setdefault(table.name, (table, [], []))
+                if item is not None:
+                    batch[1].append(item)
+                else:
+                    batch[2].append(key)
+            batch_list = memon.table.layer2.new_batch_write_list()
+            for table, table_puts, table_deletes in tables.values():
+                batch_list.add_batch(table, puts=table_puts,
+                                     deletes=table_deletes)
+            request = batch_list.to_dict()
+            attempt = 0
+            while request:
+                if attempt >= max_attempts:
+                    raise Exception('Unable to write %d unprocessed items' %
+                                    (sum(len(v) for v in request.values())))
+                if attempt:
+                    memon.metrics.inc('memon_unprocessed_retries')
+                    time.sleep(0.05 * 2 ** attempt)
+                response = memon.table.layer2.layer1.batch_write_item(
+                    request)
+                request = response.get('UnprocessedItems')
+                attempt += 1
+
+
+class SqliteBackend(object):
+    # Stands in for DynamoDB, SQS and SNS with one local SQLite database, so
+    # MEMon runs on premises or in benchmarks without AWS. The table, queue
+    # and publish methods duck type the parts of boto MEMon uses.
+    # NotifyTime is a column with an index, so down events are found with a
+    # range query instead of a scan.
+
+    visibility_timeout = 30
+
+    def __init__(self, path, echo=False):
+        self.path = path
+        # print notifications as they're published, for cron to mail on
+        self.echo = echo
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS events ('
+                         'tbl TEXT, name TEXT, notify_time INTEGER, '
+                         'data TEXT, PRIMARY KEY (tbl, name))')
+            conn.execute('CREATE INDEX IF NOT EXISTS events_notify_time '
+                         'ON events (tbl, notify_time)')
+            conn.execute('CREATE TABLE IF NOT EXISTS messages ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'queue TEXT, body TEXT, visible INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS messages_visible '
+                         'ON messages (queue, visible)')
+            conn.execute('CREATE TABLE IF NOT EXISTS notifications ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'topic TEXT, subject TEXT, message TEXT, '
+                         'created INTEGER)')
+
+    @property
+    def conn(self):
+        # sqlite connections can't be shared between threads. Transactions
+        # are explicit so conditional writes can hold the lock while they
+        # check.
+        if not hasattr(self.local, 'conn'):
+            import sqlite3
+            self.local.conn = sqlite3.connect(self.path, timeout=30,
+                                              isolation_level=None)
+        return self.local.conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def init(self):
+        print 'Created sqlite database %s' % (self.path)
+
+    def table(self, name):
+        return SqliteTable(self, name)
+
+    def due_table(self, name):
+        # NotifyTime is indexed in the events table itself
+        return None
+
+    def queue(self, name):
+        return SqliteQueue(self, name)
+
+    def topic_arn(self, name):
+        return name
+
+    def publisher(self):
+        return self
+
+    def publish(self, topic, message, subject):
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO notifications (topic, subject, '
+                         'message, created) VALUES (?, ?, ?, ?)',
+                         (topic, subject, message, int(time.time())))
+        if self.echo:
+            print '%s\n%s\n' % (subject, message)
+
+    def notifications(self, topic):
+        return self.conn.execute('SELECT subject, message FROM notifications '
+                                 'WHERE topic = ? ORDER BY id',
+                                 (topic,)).fetchall()
+
+    def down_events(self, table, now):
+        return table.due(now)
+
+    def reindex(self):
+        # There's no due index to clear, only NotifyTime to recalculate
+        pass
+
+    def scan_segment(self, table, segment, total_segments, scan_filter=None,
+                     attributes_to_get=None):
+        yield [dict(item) for item in table.scan(
+            scan_filter, attributes_to_get, segment, total_segments)], 0
+
+    def init_record_worker(self):
+        # sqlite connections are already one per thread
+        pass
+
+    def batch_write(self, puts, deletes):
+        with self.transaction() as conn:
+            for item in puts:
+                item.table.write(conn, item)
+            for table, key in deletes:
+                table.delete_key(conn, key)
+
+
+class SqliteItem(dict):
+    # Like a boto Item, expected_value maps attributes to the value they
+    # must have, or False for ones that must not exist
+
+    def __init__(self, table, attrs=None):
+        dict.__init__(self, attrs or {})
+        self.table = table
+
+    def check(self, conn, expected_value):
+        if not expected_value:
+            return
+        from boto.dynamodb.exceptions import \
+            DynamoDBConditionalCheckFailedError
+
+        current = self.table.read(conn, self[Schema.Name]) or {}
+        for attr, value in expected_value.items():
+            if current.get(attr, False) != value:
+                raise DynamoDBConditionalCheckFailedError(
+                    400, 'The conditional request failed')
+
+    def put(self, expected_value=None):
+        with self.table.backend.transaction() as conn:
+            self.check(conn, expected_value)
+            self.table.write(conn, self)
+
+    # Everything is written locally, so there's no need to only send
+    # the changed attributes
+    save = put
+
+    def add_attribute(self, attr, value):
+        # The new value is already set and put writes it within the
+        # transaction, so there's nothing to queue
+        pass
+
+    def delete(self, expected_value=None):
+        with self.table.backend.transaction() as conn:
+            self.check(conn, expected_value)
+            self.table.delete_key(conn, self[Schema.Name])
+
+
+class SqliteTable(object):
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def new_item(self, hash_key=None, range_key=None, attrs=None):
+        item = SqliteItem(self, attrs)
+        if hash_key is not None:
+            item[Schema.Name] = hash_key
+        return item
+
+    def read(self, conn, name):
+        row = conn.execute('SELECT data FROM events WHERE tbl = ? AND '
+                           'name = ?', (self.name, name)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def write(self, conn, item):
+        conn.execute('INSERT OR REPLACE INTO events (tbl, name, notify_time, '
+                     'data) VALUES (?, ?, ?, ?)',
+                     (self.name, item[Schema.Name],
+                      item.get(Schema.NotifyTime), json.dumps(item)))
+
+    def delete_key(self, conn, name):
+        conn.execute('DELETE FROM events WHERE tbl = ? AND name = ?',
+                     (self.name, name))
+
+    def get_item(self, hash_key, range_key=None, attributes_to_get=None,
+                 consistent_read=False):
+        attrs = self.read(self.backend.conn, hash_key)
+        if attrs is None:
+            from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
+            raise DynamoDBKeyNotFoundError('Key does not exist.')
+        return self.new_item(attrs=attrs)
+
+    def batch_get_item(self, names):
+        for name in names:
+            attrs = self.read(self.backend.conn, name)
+            if attrs is not None:
+                yield attrs
+
+    # The scan_filter comparisons supported
+    comparisons = {
+        'EQ': lambda value, v1: value == v1,
+        'NE': lambda value, v1: value != v1,
+        'LT': lambda value, v1: value < v1,
+        'LE': lambda value, v1: value <= v1,
+        'GT': lambda value, v1: value > v1,
+        'GE': lambda value, v1: value >= v1,
+    }
+
+    def matches(self, attrs, scan_filter):
+        for attr, condition in (scan_filter or {}).items():
+            compare = self.comparisons[condition.__class__.__name__]
+            if attr not in attrs or not compare(attrs[attr], condition.v1):
+                return False
+        return True
+
+    def scan(self, scan_filter=None, attributes_to_get=None, segment=None,
+             total_segments=None):
+        # Segments split the events by a hash of their name, like DynamoDB
+        # splits them by hash key
+        for row in self.backend.conn.execute('SELECT data FROM events '
+                                             'WHERE tbl = ? ORDER BY name',
+                                             (self.name,)).fetchall():
+            attrs = json.loads(row[0])
+            if (total_segments and
+                    name_hash(attrs[Schema.Name]) % total_segments != segment):
+                continue
+            if not self.matches(attrs, scan_filter):
+                continue
+            if attributes_to_get:
+                attrs = dict((attr, attrs[attr]) for attr in attributes_to_get
+                             if attr in attrs)
+            yield self.new_item(attrs=attrs)
+
+    def due(self, now):
+        # Events whose NotifyTime has passed, off the notify_time index
+        for row in self.backend.conn.execute('SELECT data FROM events '
+                                             'WHERE tbl = ? AND '
+                                             'notify_time <= ? '
+                                             'ORDER BY name',
+                                             (self.name, now)).fetchall():
+            yield self.new_item(attrs=json.loads(row[0]))
+
+
+class SqliteQueue(object):
+    # Received messages are hidden for visibility_timeout seconds and only
+    # removed once deleted, like SQS
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def write(self, message):
+        self.write_batch([(None, message.get_body(), 0)])
+        return message
+
+    def write_batch(self, messages):
+        now = int(time.time())
+        with self.backend.transaction() as conn:
+            for message_id, body, delay in messages:
+                conn.execute('INSERT INTO messages (queue, body, visible) '
+                             'VALUES (?, ?, ?)',
+                             (self.name, body, now + delay))
+        return BatchResults(self)
+
+    def get_messages(self, num_messages=1, wait_time_seconds=None):
+        # Nothing can arrive while a local long poll waits that wouldn't be
+        # picked up by the next poll, so the wait is skipped
+        now = int(time.time())
+        with self.backend.transaction() as conn:
+            rows = conn.execute('SELECT id, body FROM messages '
+                                'WHERE queue = ? AND visible <= ? '
+                                'ORDER BY id LIMIT ?',
+                                (self.name, now, num_messages)).fetchall()
+            conn.executemany('UPDATE messages SET visible = ? WHERE id = ?',
+                             [(now + self.backend.visibility_timeout, row[0])
+                              for row in rows])
+        messages = []
+        for row_id, body in rows:
+            message = RawMessage(self, body)
+            message.id = message.receipt_handle = row_id
+            messages.append(message)
+        return messages
+
+    def delete_message_batch(self, messages):
+        with self.backend.transaction() as conn:
+            conn.executemany('DELETE FROM messages WHERE id = ?',
+                             [(message.receipt_handle,)
+                              for message in messages])
+        return BatchResults(self)
+
+    def count(self):
+        return self.backend.conn.execute('SELECT COUNT(*) FROM messages '
+                                         'WHERE queue = ?',
+                                         (self.name,)).fetchone()[0]
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
 
 
 class MEMon(object):
 
     # Default constructor of the class.
     def __init__(self):
+        self.region = 'us-east-1'
+        # an AwsBackend or a SqliteBackend
+        self.backend = AwsBackend(self)
+        self.metrics = Metrics()
+        self.capacity = CapacityLimiter(self.metrics)
+        self.read_capacity = 1
+        self.write_capacity = 1
+        self.metrics_path = None
+        self.metrics_format = 'prometheus'
         self.queue = "memon"
         self.table_name = "memon"
+        self.local = threading.local()
         self.table = None
+        self.due_table_name = "memon-due"
+        self.due_table = None
+        self.due_buckets = 1
+        # 0 for a single poller, otherwise pollers share out the shards
+        self.shards = 0
+        self.owned_shards = None
+        self.lease_table_name = "memon-leases"
+        self.lease_table = None
+        self.lease_ttl = 180
+        self.poller_id = socket.gethostname()
+        self.cache = None
+        self.cache_refresh = 300
+        self.resources = None
+        self.resource_ttl = 3600
+        self.spool = None
+        self.pack_size = 100
+        self.history = None
+        self.outbox = None
+        self.outbox_workers = 4
+        self.outbox_timeout = 30
+        self.outbox_max_backoff = 900
+        self.outbox_stats = {'delivered': 0, 'failed': 0, 'max_latency': 0}
+        self.outbox_pool = None
+        self.record_workers = 1
+        self.record_pool = None
+        self.batch_writes = False
+        self.scan_segments = 1
+        self.scan_pool = None
+        self.scan_capacity = None
+        self.digest = False
+        self.alerts = []
+        self.notify_bucket = None
+        self.notify_state = None
+        self.interval = 15
+        self.stopping = threading.Event()
+        self.reloading = False
         self.sns = "memon"
         self.sns_email = None
         self.debug = False
         self.max_notify_count = 3
         self.server_time = True
+        self.wait_time = 10
+        self.throttled = set()
+        self.poll_budget = 0
+        self.drain_size = 100
+        self.poll_backoff = 1
+        self.lock_path = None
+        self.delete_failures = 0
 
-        self.sqs = boto.connect_sqs()
-        self.sns_conn = boto.connect_sns()
-        self.db = boto.connect_dynamodb()
+        # connections are made on first use in self.region
+        self._sqs = None
+        self._sns_conn = None
+        self._db = None
         self.pp = pprint.PrettyPrinter()
         self.now = int(time.time())
 
+    @property
+    def table(self):
+        # record workers each have their own copy
+        table = getattr(self.local, 'table', None)
+        return self._table if table is None else table
+
+    @table.setter
+    def table(self, table):
+        self._table = table
+
+    @property
+    def due_table(self):
+        table = getattr(self.local, 'due_table', None)
+        return self._due_table if table is None else table
+
+    @due_table.setter
+    def due_table(self, table):
+        self._due_table = table
+
+    @property
+    def sqs(self):
+        if self._sqs is None:
+            import boto.sqs
+            self.sqs = boto.sqs.connect_to_region(self.region)
+        return self._sqs
+
+    @sqs.setter
+    def sqs(self, conn):
+        self._sqs = self.metrics.instrument(conn, 'sqs')
+
+    @property
+    def sns_conn(self):
+        if self._sns_conn is None:
+            self.sns_conn = self.backend.publisher()
+        return self._sns_conn
+
+    @sns_conn.setter
+    def sns_conn(self, conn):
+        self._sns_conn = self.metrics.instrument(conn, 'sns')
+
+    @property
+    def db(self):
+        if self._db is None:
+            import boto.dynamodb
+            self.db = boto.dynamodb.connect_to_region(self.region)
+        return self._db
+
+    @db.setter
+    def db(self, conn):
+        if conn is not None and hasattr(conn, 'layer1'):
+            self.metrics.instrument(conn.layer1, 'dynamodb')
+            self.capacity.install(conn.layer1)
+        self._db = conn
+
     def aws_init(self):
+        from boto.dynamodb2.fields import HashKey
+        from boto.dynamodb2.fields import RangeKey
+        from boto.dynamodb2.table import Table
+        from boto.dynamodb2.types import NUMBER
+
         print 'Creating sqs queue %s' % (self.queue)
         self.sqs.create_queue(self.queue)
 
@@ -62,7 +1800,27 @@ class MEMon(object):
         try:
             Table.create(self.table_name,
                          schema=[HashKey(Schema.Name)],
-                         throughput={'read': 1, 'write': 1})
+                         throughput={'read': self.read_capacity,
+                                     'write': self.write_capacity})
+        except boto.exception.JSONResponseError as e:
+            print e
+
+        print 'Creating dynamodb due index table %s' % (self.due_table_name)
+        try:
+            Table.create(self.due_table_name,
+                         schema=[HashKey(DueSchema.Bucket, data_type=NUMBER),
+                                 RangeKey(DueSchema.Due)],
+                         throughput={'read': self.read_capacity,
+                                     'write': self.write_capacity})
+        except boto.exception.JSONResponseError as e:
+            print e
+
+        print 'Creating dynamodb lease table %s' % (self.lease_table_name)
+        try:
+            Table.create(self.lease_table_name,
+                         schema=[HashKey(LeaseSchema.Name)],
+                         throughput={'read': self.read_capacity,
+                                     'write': self.write_capacity})
         except boto.exception.JSONResponseError as e:
             print e
 
@@ -80,7 +1838,6 @@ class MEMon(object):
             print 'Remember to subscribe to the sns topic %s' % (self.sns)
 
     def send(self, name):
-        q = self.sqs.get_queue(self.queue)
         m = RawMessage()
         msg = {
             'name': name,
@@ -88,99 +1845,647 @@ class MEMon(object):
         }
         if self.debug:
             self.pp.pprint(msg)
+        if self.spool:
+            self.spool.append(msg)
+            return
         m.set_body(json.dumps(msg))
-        q.write(m)
+        try:
+            self.get_queue().write(m)
+        except boto.exception.BotoServerError:
+            # retry once if the cached queue url may have gone stale
+            if not self.invalidate_resource('queue', self.queue):
+                raise
+            self.get_queue().write(m)
+
+    def flush(self):
+        # Send everything spooled as packed messages, up to pack_size
+        # heartbeats per message and 10 messages per SendMessageBatch.
+        # Returns the number of heartbeats sent.
+        sent = 0
+        while True:
+            msgs = self.spool.take()
+            if msgs is None:
+                return sent
+            try:
+                events = {}
+                for msg in msgs:
+                    if msg['time'] > events.get(msg['name'], 0):
+                        events[msg['name']] = msg['time']
+                self.send_events(events)
+                self.spool.done()
+            finally:
+                self.spool.release()
+            sent += len(msgs)
+            if self.debug:
+                print ('Flushed %d heartbeats for %d events' %
+                       (len(msgs), len(events)))
 
-    def poll(self):
-        q = self.sqs.get_queue(self.queue)
-        results = q.get_messages(10)
-        for result in results:
-            msg = json.loads(result.get_body())
+    def send_events(self, events):
+        # Send the newest time per event name as packed messages
+        packed = [{'name': name, 'time': event_time}
+                  for name, event_time in sorted(events.items())]
+        self.send_batch([json.dumps({'events': packed[i:i + self.pack_size]})
+                         for i in xrange(0, len(packed), self.pack_size)])
+
+    def send_batch(self, bodies):
+        q = self.get_queue()
+        for i in xrange(0, len(bodies), 10):
+            batch = [(str(n), body, 0)
+                     for n, body in enumerate(bodies[i:i + 10])]
+            try:
+                results = q.write_batch(batch)
+            except boto.exception.BotoServerError:
+                if not self.invalidate_resource('queue', self.queue):
+                    raise
+                q = self.get_queue()
+                results = q.write_batch(batch)
+            if results.errors:
+                # leave the spool to be sent again, repeats are harmless as
+                # only the newest heartbeat per event is recorded
+                raise Exception('Failed to send %d of %d messages' %
+                                (len(results.errors), len(batch)))
+
+    def poll(self, poll_count=1):
+        # Receives poll_count batches of messages or, with a poll_budget,
+        # keeps receiving until the queue is empty or the budget is spent.
+        # Every drain_size messages are recorded and deleted as they come so
+        # none are redelivered once their visibility timeout runs out.
+        q = self.get_queue()
+        started = time.time()
+        results = []
+        total = 0
+        i = 0
+        drained = False
+        while True:
+            wait_time = self.wait_time
+            if self.poll_budget:
+                # a long poll never waits past the budget
+                remaining = self.poll_budget - (time.time() - started)
+                if remaining <= 0:
+                    break
+                wait_time = min(wait_time, int(remaining))
+            elif i >= poll_count:
+                break
             if self.debug:
-                print msg
-            self.record(msg['name'], msg['time'])
-            q.delete_message(result)
+                print "Poll attempt %d" % (i)
+            try:
+                received = q.get_messages(10, wait_time_seconds=wait_time)
+            except boto.exception.BotoServerError:
+                # retry once if the cached queue url may have gone stale
+                if i or not self.invalidate_resource('queue', self.queue):
+                    raise
+                q = self.get_queue()
+                received = q.get_messages(10, wait_time_seconds=wait_time)
+            # heartbeat lag counts until the batch arrived rather than from
+            # the start of the cycle, which a long drain could be well past
+            received_at = time.time()
+            for message in received:
+                message.received_at = received_at
+            results.extend(received)
+            i += 1
+            # a long poll only returns empty once the queue is drained, a
+            # short poll may miss messages so tries again
+            drained = not received and wait_time > 0
+            if drained or len(results) >= self.drain_size:
+                total += self.process_messages(q, results)
+                results = []
+            if drained:
+                break
+            if not received and self.poll_budget:
+                # rather than receiving back to back for the whole budget
+                time.sleep(min(self.poll_backoff, remaining))
+        total += self.process_messages(q, results)
+
+        if self.poll_budget:
+            backlog = q.count()
+            self.metrics.set('memon_queue_backlog', backlog)
+            if backlog and not drained:
+                print ('Poll budget of %ds spent with about %d messages '
+                       'left' % (self.poll_budget, backlog))
+        return total
+
+    def process_messages(self, q, messages):
+        self.metrics.inc('memon_messages_received', len(messages))
+        self.throttled = set()
+        if messages:
+            self.record_batch(self.coalesce(messages))
+        done = messages
+        if self.throttled:
+            # left for sqs to redeliver once their visibility timeout is up
+            self.metrics.inc('memon_throttled_events', len(self.throttled))
+            done = [message for message in messages
+                    if not self.throttled.intersection(
+                        name for name, event_time
+                        in self.message_events(message))]
+        self.delete_messages(q, done)
+        return len(messages)
+
+    def coalesce(self, messages):
+        # Only the newest heartbeat per event matters to record, as anything
+        # older than LastSuccessTime would be ignored anyway
+        events = {}
+        for message in messages:
+            for name, event_time in self.message_events(message):
+                if name not in events or event_time > events[name]:
+                    events[name] = event_time
+                self.metrics.observe('memon_heartbeat_lag_seconds',
+                                     max(0, message.received_at - event_time))
+        return events
+
+    def message_events(self, message):
+        # (name, time) of each heartbeat in a message, as flush packs many
+        # heartbeats into one message
+        msg = json.loads(message.get_body())
+        if self.debug:
+            print msg
+        return [(msg['name'], int(msg['time']))
+                for msg in msg.get('events', [msg])]
+
+    def delete_messages(self, q, messages):
+        # DeleteMessageBatch accepts at most 10 receipts per call
+        failed = 0
+        for i in xrange(0, len(messages), 10):
+            batch = messages[i:i + 10]
+            results = q.delete_message_batch(batch)
+            if results.errors:
+                print ('Failed to delete %d of %d messages' %
+                       (len(results.errors), len(batch)))
+                if self.debug:
+                    self.pp.pprint(results.errors)
+            failed += len(results.errors)
+        self.delete_failures += failed
+        self.metrics.inc('memon_messages_deleted', len(messages) - failed)
+        self.metrics.inc('memon_delete_failures', failed)
+        return failed
+
+    def scan_events(self, scan_filter=None, attributes_to_get=None):
+        # Streams the events from a full table scan. With --scan-segments the
+        # segments are scanned in parallel, each on a scan worker thread, and
+        # events are yielded as their pages arrive.
+        if self.scan_segments <= 1:
+            for item in self.table.scan(scan_filter=scan_filter,
+                                        attributes_to_get=attributes_to_get):
+                yield self.load_item(item)
+            return
+        from Queue import Queue as PageQueue
+
+        if self.scan_pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.scan_pool = ThreadPool(self.scan_segments)
+        pages = PageQueue()
+        bucket = None
+        if self.scan_capacity:
+            bucket = TokenBucket(self.scan_capacity, self.scan_capacity)
+        lock = threading.Lock()
+        stop = threading.Event()
+        for segment in xrange(self.scan_segments):
+            self.scan_pool.apply_async(self.scan_worker, (
+                segment, pages, scan_filter, attributes_to_get, bucket, lock,
+                stop))
+        try:
+            running = self.scan_segments
+            while running:
+                page = pages.get()
+                if page is None:
+                    running -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    for attrs in page:
+                        yield self.load_item(attrs)
+        finally:
+            # the workers stop at their next page if we stopped early
+            stop.set()
+
+    def scan_worker(self, segment, pages, scan_filter, attributes_to_get,
+                    bucket, lock, stop):
+        # Runs on a scan worker, putting each page of the segment on pages
+        # then None once done, or the error if any
+        try:
+            for page, units in self.scan_segment(segment, scan_filter,
+                                                 attributes_to_get):
+                if stop.is_set():
+                    return
+                pages.put(page)
+                if bucket is not None:
+                    # keeps every segment together under --scan-capacity
+                    with lock:
+                        wait = bucket.borrow(units)
+                    stop.wait(wait)
+            pages.put(None)
+        except Exception as e:
+            pages.put(e)
+
+    def scan_segment(self, segment, scan_filter=None, attributes_to_get=None):
+        # Yields each page of the segment and the read capacity it consumed
+        return self.backend.scan_segment(self.table, segment,
+                                         self.scan_segments, scan_filter,
+                                         attributes_to_get)
 
     def show(self, name=None, error_only=False):
-        results = sorted(list(self.table.scan()), key=(
-            lambda event:
-            int(event[Schema.NextBlockTime]) if Schema.NextBlockTime in event
-            else 0))
+        from boto.dynamodb.condition import GT
+        from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
+
+        if name is not None:
+            try:
+                results = [self.table.get_item(name)]
+            except DynamoDBKeyNotFoundError:
+                results = []
+        else:
+            scan_filter = None
+            if error_only:
+                scan_filter = {Schema.ErrorCount: GT(0)}
+            results = sorted(self.scan_events(scan_filter), key=(
+                lambda event:
+                int(event[Schema.NextBlockTime])
+                if Schema.NextBlockTime in event else 0))
         for event in results:
+            # scans filter errors server side, get_item can't
             if (error_only and
                 (not Schema.ErrorCount in event or
                  event[Schema.ErrorCount] == 0)):
                 continue
-            if name is None or name == event[Schema.Name]:
-                print "\n%s\n---" % (event[Schema.Name])
-                try:
-                    if not event[Schema.Enabled]:
-                        print "***DISABLED***"
-                    if (Schema.ErrorCount in event and
-                            event[Schema.ErrorCount] > 0):
-                        print ("***ERRORS (%d)***" %
-                               (event[Schema.ErrorCount]))
-                    if Schema.Description in event:
-                        print "Desc: %s" % event[Schema.Description]
-                    print "Type: %s" % event[Schema.Type]
-                    period_sec = datetime.timedelta(
-                        seconds=event[Schema.Period])
-                    print ("Period: %s (%ds)" %
-                           (str(period_sec), event[Schema.Period]))
-                    if Schema.NextBlockTime in event:
-                        print ("Due: %s" %
-                               time.ctime(event[Schema.NextBlockTime]))
-                    if Schema.LastSuccessTime in event:
-                        print ("Last Ran: %s" %
-                               time.ctime(event[Schema.LastSuccessTime]))
-
-                    if self.debug:
-                        self.pp.pprint(dict(event))
-                except Exception:
+            print "\n%s\n---" % (event[Schema.Name])
+            try:
+                if not event[Schema.Enabled]:
+                    print "***DISABLED***"
+                if (Schema.ErrorCount in event and
+                        event[Schema.ErrorCount] > 0):
+                    print ("***ERRORS (%d)***" %
+                           (event[Schema.ErrorCount]))
+                if Schema.Description in event:
+                    print "Desc: %s" % event[Schema.Description]
+                print "Type: %s" % event[Schema.Type]
+                if Schema.Schedule in event:
+                    print "Schedule: %s" % event[Schema.Schedule]
+                period_sec = datetime.timedelta(
+                    seconds=event[Schema.Period])
+                print ("Period: %s (%ds)" %
+                       (str(period_sec), event[Schema.Period]))
+                if Schema.NextBlockTime in event:
+                    print ("Due: %s" %
+                           time.ctime(event[Schema.NextBlockTime]))
+                if Schema.LastSuccessTime in event:
+                    print ("Last Ran: %s" %
+                           time.ctime(event[Schema.LastSuccessTime]))
+
+                if self.debug:
                     self.pp.pprint(dict(event))
+            except Exception:
+                self.pp.pprint(dict(event))
         print "\n"
 
     def notify_down_events(self):
-        results = self.table.scan()
+        from boto.dynamodb.exceptions import \
+            DynamoDBConditionalCheckFailedError, \
+            DynamoDBKeyNotFoundError, DynamoDBThroughputExceededError
+
+        if self.cache:
+            results = [self.load_item(attrs)
+                       for attrs in self.cache.due(self.now)]
+        else:
+            results = self.backend.down_events(self.table, self.now)
         for event in results:
+            # other pollers look after the shards we don't own
+            if (self.owned_shards is not None and
+                    self.shard(event[Schema.Name]) not in self.owned_shards):
+                continue
             # we only want to notify based on the period,
             # so we're not notifying every minute
             error_count = 0
             if Schema.ErrorCount in event and event[Schema.ErrorCount]:
                 error_count = event[Schema.ErrorCount]
-            next_notify = None
-            if Schema.NextBlockTime in event:
-                next_notify = (event[Schema.NextBlockTime] +
-                               error_count * event[Schema.Period])
-            is_enabled = Schema.Enabled in event and event[Schema.Enabled]
-            if next_notify and next_notify <= self.now and is_enabled:
+            next_notify = self.notify_time(event)
+            if next_notify is not None and next_notify <= self.now:
+                self.metrics.inc('memon_down_events')
                 if self.debug:
                     print "%s\n---" % (event[Schema.Name])
                     self.pp.pprint(dict(event))
+                # Only ErrorCount and Version are sent, on condition that
+                # no heartbeat has moved NextBlockTime since it was read
+                self.increment(event, Schema.ErrorCount)
+                try:
+                    self.save_event(event, {
+                        Schema.NextBlockTime:
+                            event.get(Schema.NextBlockTime, False)})
+                except DynamoDBConditionalCheckFailedError:
+                    # Changed since it was read, check it again next poll
+                    try:
+                        self.reload_event(event[Schema.Name])
+                    except DynamoDBKeyNotFoundError:
+                        pass
+                    continue
+                except DynamoDBThroughputExceededError:
+                    # Not saved, so it's found down again next poll
+                    self.metrics.inc('memon_throttled_events')
+                    continue
                 if error_count < int(self.max_notify_count):
                     self.notify(event[Schema.Name], Notification.Down, event)
                 elif self.debug:
                     print "Exceeded notify count for %s" % (event[Schema.Name])
-                event[Schema.ErrorCount] = error_count + 1
-                event.save()
 
-    def get_topic_arn(self):
-        # todo: handle pagination of topics
-        next_token = None
-        while True:
-            all_topics = self.sns_conn.get_all_topics(next_token)
-            next_token = all_topics['ListTopicsResponse']['ListTopicsResult']['NextToken']
-            topics = all_topics['ListTopicsResponse']['ListTopicsResult']['Topics']
-            for topic in topics:
-                if topic['TopicArn'].endswith(':' + self.sns):
-                    # todo: cache arn
-                    return topic['TopicArn']
+    def notify_time(self, event):
+        # When notify_down_events next needs to look at the event, or None
+        # if it never does (disabled or not yet scheduled)
+        if (not event.get(Schema.Enabled) or
+                Schema.NextBlockTime not in event or
+                Schema.Period not in event):
+            return None
+        error_count = event.get(Schema.ErrorCount) or 0
+        return int(event[Schema.NextBlockTime] +
+                   error_count * event[Schema.Period])
 
-        raise Exception('Unable to locate topic arn for %s' % (self.sns))
+    def due_bucket(self, name):
+        return name_hash(name) % self.due_buckets
 
-    def notify(self, name, notification, event=None):
-        topicArn = self.get_topic_arn()
+    def due_key(self, name, notify_time):
+        # Zero padded so the range key sorts by time
+        return '%010d:%s' % (notify_time, name)
+
+    def index_event(self, event):
+        # Keeps NotifyTime in step with the event and returns the
+        # (puts, deletes) needed to move its row in the due index
+        puts = []
+        deletes = []
+        name = event[Schema.Name]
+        old_time = event.get(Schema.NotifyTime)
+        new_time = self.notify_time(event)
+        if old_time == new_time:
+            return puts, deletes
+
+        if new_time is None:
+            del event[Schema.NotifyTime]
+        else:
+            event[Schema.NotifyTime] = new_time
+        if self.due_table:
+            bucket = self.due_bucket(name)
+            if old_time is not None:
+                deletes.append((self.due_table,
+                                (bucket, self.due_key(name, old_time))))
+            if new_time is not None:
+                puts.append(self.due_table.new_item(
+                    hash_key=bucket,
+                    range_key=self.due_key(name, new_time),
+                    attrs={DueSchema.Name: name}))
+        return puts, deletes
+
+    def conditional_writes(self):
+        # Something else may be writing the same events: a cached copy,
+        # other pollers or other record workers
+        return bool(self.cache or self.shards or self.record_workers > 1)
+
+    def load_item(self, attrs):
+        # An item holding attrs as already saved, so save() only sends the
+        # attributes changed after this rather than rewriting the whole item
+        item = self.table.new_item(hash_key=attrs[Schema.Name])
+        dict.update(item, attrs)
+        return item
+
+    def increment(self, event, attr, value=1):
+        # An atomic ADD, so concurrent increments are never lost
+        dict.__setitem__(event, attr, (event.get(attr) or 0) + value)
+        event.add_attribute(attr, value)
+
+    def save_event(self, event, expected_value=None):
+        # UpdateItem with just the changed attributes. With a cache or
+        # several pollers, the write is also conditional on the Version the
+        # event was read at so stale state can never clobber newer state
+        expected = dict(expected_value or {})
+        version = event.get(Schema.Version)
+        event[Schema.Version] = (version or 0) + 1
+        if self.conditional_writes():
+            if version is None:
+                version = False
+            expected[Schema.Version] = version
+        self.write_indexed(
+            event, lambda: event.save(expected_value=expected or None))
+
+    def write_indexed(self, event, write):
+        # Moves the event's due row around write(), which saves the event.
+        # The new row goes in first and the old one comes out after, so an
+        # error before write() means nothing was saved, and one after it
+        # only leaves a stale row that is dropped once it comes due.
+        puts, deletes = self.index_event(event)
+        self.batch_write(puts, [])
+        write()
+        if self.cache:
+            self.cache.put(event, self.notify_time(event))
+        try:
+            self.batch_write([], deletes)
+        except Exception as e:
+            if self.debug:
+                print e
+
+    def get_event(self, name):
+        if self.cache:
+            attrs = self.cache.get(name)
+            if attrs is not None:
+                return self.load_item(attrs)
+            return self.reload_event(name)
+        return self.load_item(self.table.get_item(name))
+
+    def reload_event(self, name):
+        # Re-read an event from the table, refreshing its cached copy
+        from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
+
+        try:
+            event = self.load_item(
+                self.table.get_item(name, consistent_read=True))
+        except DynamoDBKeyNotFoundError:
+            if self.cache:
+                self.cache.delete(name)
+            raise
+        if self.cache:
+            self.cache.put(event, self.notify_time(event))
+        return event
+
+    def refresh_cache(self, force=False):
+        # Incremental refresh: only the Name and Version of each event are
+        # scanned, and just the events whose Version moved are fetched
+        refreshed = self.cache.get_meta('refreshed')
+        if (not force and refreshed is not None and
+                self.now - refreshed < self.cache_refresh):
+            return 0
+
+        versions = self.cache.versions()
+        changed = []
+        for item in self.scan_events(attributes_to_get=[Schema.Name,
+                                                        Schema.Version]):
+            name = item[Schema.Name]
+            if name not in versions or (versions.pop(name) !=
+                                        item.get(Schema.Version)):
+                changed.append(name)
+        # whatever is left over no longer exists in the table
+        for name in versions:
+            self.cache.delete(name)
+        if changed:
+            for attrs in self.table.batch_get_item(changed):
+                self.cache.put(attrs, self.notify_time(attrs))
+        self.cache.set_meta('refreshed', self.now)
+        if self.debug:
+            print 'Refreshed %d cached events' % (len(changed))
+        return len(changed)
+
+    def due_events(self):
+        # Query the due index for everything due by now, then load just those
+        # events. ':' sorts before ';' so every name due at self.now matches.
+        from boto.dynamodb.condition import LT
 
+        buckets = xrange(self.due_buckets)
+        if self.owned_shards is not None and self.due_buckets == self.shards:
+            buckets = self.owned_shards
+        rows = []
+        for bucket in buckets:
+            rows.extend(self.due_table.query(
+                bucket, range_key_condition=LT('%010d;' % (self.now))))
+        if not rows:
+            return []
+
+        names = sorted(set(row[DueSchema.Name] for row in rows))
+        found = {}
+        for attrs in self.table.batch_get_item(names):
+            found[attrs[Schema.Name]] = self.load_item(attrs)
+
+        # Rows that don't match the event's NotifyTime are left over from a
+        # deleted or reconfigured event
+        deletes = []
+        for row in rows:
+            event = found.get(row[DueSchema.Name])
+            if (event is None or Schema.NotifyTime not in event or
+                    row[DueSchema.Due] != self.due_key(
+                        event[Schema.Name], event[Schema.NotifyTime])):
+                deletes.append((self.due_table,
+                                (row[DueSchema.Bucket], row[DueSchema.Due])))
+        self.batch_write([], deletes)
+
+        return [found[name] for name in names if name in found]
+
+    def reindex(self):
+        # Rebuild the due index from scratch, eg after creating the table.
+        # The sqlite backend indexes NotifyTime itself, so only that needs
+        # recalculating.
+        self.backend.reindex()
+
+        events = []
+        for event in self.table.scan():
+            event.pop(Schema.NotifyTime, None)
+            events.append(event)
+        self.save_batch(events)
+        print 'Indexed %d events' % (len(events))
+
+    def shard(self, name):
+        # Same hash as the due index, so with as many due buckets as shards
+        # a poller only queries its own buckets
+        return name_hash(name) % self.shards
+
+    def claim_shards(self):
+        # Heartbeat this poller, renew its leases and claim free or expired
+        # shards up to a fair share of the live pollers. Leases beyond that
+        # share are released for pollers that have just started. Returns
+        # the shards this poller owns.
+        self.lease_table.new_item(
+            hash_key='poller:%s' % (self.poller_id),
+            attrs={LeaseSchema.Owner: self.poller_id,
+                   LeaseSchema.Expires: self.now + self.lease_ttl}).put()
+
+        pollers = set()
+        leases = {}
+        for row in self.lease_table.scan():
+            kind, name = row[LeaseSchema.Name].split(':', 1)
+            if kind == 'poller' and row[LeaseSchema.Expires] > self.now:
+                pollers.add(row[LeaseSchema.Owner])
+            elif kind == 'shard':
+                leases[int(name)] = row
+        pollers.add(self.poller_id)
+        share = -(-self.shards // len(pollers))
+
+        owned = []
+        mine = [shard for shard in sorted(leases)
+                if shard < self.shards and
+                leases[shard][LeaseSchema.Owner] == self.poller_id]
+        for shard in mine:
+            if len(owned) < share:
+                if self.put_lease(shard, leases[shard]):
+                    owned.append(shard)
+            else:
+                self.release_lease(shard)
+        for shard in xrange(self.shards):
+            if len(owned) >= share:
+                break
+            lease = leases.get(shard)
+            if lease is not None and (lease[LeaseSchema.Owner] ==
+                                      self.poller_id or
+                                      lease[LeaseSchema.Expires] > self.now):
+                continue
+            if self.put_lease(shard, lease):
+                owned.append(shard)
+        owned.sort()
+        if self.debug:
+            print 'Own shards %s of %d live pollers' % (owned, len(pollers))
+        self.metrics.set('memon_owned_shards', len(owned))
+        return owned
+
+    def put_lease(self, shard, lease):
+        # Conditional on the lease being as we read it, returns False if
+        # another poller got there first
+        from boto.dynamodb.exceptions import \
+            DynamoDBConditionalCheckFailedError
+
+        if lease is None:
+            expected = {LeaseSchema.Owner: False}
+        else:
+            expected = {LeaseSchema.Owner: lease[LeaseSchema.Owner],
+                        LeaseSchema.Expires: lease[LeaseSchema.Expires]}
+        try:
+            self.lease_table.new_item(
+                hash_key='shard:%d' % (shard),
+                attrs={LeaseSchema.Owner: self.poller_id,
+                       LeaseSchema.Expires: self.now + self.lease_ttl}).put(
+                expected_value=expected)
+        except DynamoDBConditionalCheckFailedError:
+            return False
+        return True
+
+    def release_lease(self, shard):
+        from boto.dynamodb.exceptions import \
+            DynamoDBConditionalCheckFailedError
+
+        try:
+            self.lease_table.new_item(hash_key='shard:%d' % (shard)).delete(
+                expected_value={LeaseSchema.Owner: self.poller_id})
+        except DynamoDBConditionalCheckFailedError:
+            pass
+
+    def release_shards(self):
+        # Hand every shard straight over on a clean shutdown rather than
+        # waiting for the leases to expire
+        for shard in self.owned_shards or []:
+            self.release_lease(shard)
+        self.owned_shards = None
+        self.lease_table.new_item(
+            hash_key='poller:%s' % (self.poller_id)).delete()
+
+    def resource_key(self, kind, name):
+        return '%s:%s:%s' % (kind, self.region, name)
+
+    def invalidate_resource(self, kind, name):
+        # Returns True if there was a cached resource to drop
+        if not self.resources:
+            return False
+        return self.resources.invalidate(self.resource_key(kind, name))
+
+    def get_queue(self):
+        return self.backend.queue(self.queue)
+
+    def get_table(self, name):
+        return self.backend.table(name)
+
+    def get_topic_arn(self, sns=None):
+        if sns is None:
+            sns = self.sns
+        return self.backend.topic_arn(sns)
+
+    def notify(self, name, notification, event=None):
         message = None
         if notification == Notification.Down:
             message = 'Down: %s' % (name)
@@ -195,67 +2500,443 @@ class MEMon(object):
 
         if self.debug:
             print message
+        self.metrics.inc('memon_notifications', type=message.split(':')[0])
+        if self.history:
+            self.history.add(self.now, name, notification)
 
-        subject = "[MEMon] %s" % (message)
-        message = "MEMon Alert\n-----------\n\n%s" % (message)
+        description = None
         if event:
             if Schema.Description in event:
-                message = ("%s\n%s: %s" %
-                          (message, name, event[Schema.Description]))
+                description = event[Schema.Description]
 
+        if self.digest:
+            # published by flush_alerts at the end of the poll cycle
+            self.alerts.append((self.sns, notification, name, message,
+                                description))
+            return
+
+        subject = "[MEMon] %s" % (message)
+        message = "MEMon Alert\n-----------\n\n%s" % (
+            self.alert_text(name, message, description))
         message = "%s\n\n--\nMEMon" % (message)
-        self.sns_conn.publish(topicArn, message, subject)
+        self.publish(subject, message)
 
-    def record(self, name, event_time):
-        if self.server_time:
-            event_time = self.now
-        else:
-            event_time = int(event_time)
+    def alert_text(self, name, message, description):
+        if description is None:
+            return message
+        return "%s\n%s: %s" % (message, name, description)
+
+    def flush_alerts(self):
+        # Publish the alerts gathered this cycle as one digest per topic. A
+        # lone alert looks just like it would without digests. Alerts over
+        # the rate limit are kept for the next digest.
+        topics = {}
+        for alert in self.alerts:
+            topics.setdefault(alert[0], []).append(alert)
+        self.alerts = []
+
+        published = 0
+        for sns in sorted(topics):
+            alerts = topics[sns]
+            if self.notify_bucket and not self.notify_bucket.consume():
+                if self.debug:
+                    print 'Rate limited %d alerts for %s' % (len(alerts), sns)
+                self.alerts.extend(alerts)
+                continue
+
+            if len(alerts) == 1:
+                subject = "[MEMon] %s" % (alerts[0][3])
+            else:
+                counts = []
+                for notification, label in [
+                        (Notification.Down, 'Down'),
+                        (Notification.Up, 'Up'),
+                        (Notification.Late, 'Late'),
+                        (Notification.ConfigError, 'Config')]:
+                    count = len([alert for alert in alerts
+                                 if alert[1] == notification])
+                    if count:
+                        counts.append('%d %s' % (count, label))
+                subject = "[MEMon] %d alerts: %s" % (len(alerts),
+                                                     ', '.join(counts))
+            message = "MEMon Alert\n-----------\n\n%s" % ("\n\n".join(
+                self.alert_text(name, text, description)
+                for sns, notification, name, text, description in alerts))
+            message = "%s\n\n--\nMEMon" % (message)
+            self.publish(subject, message, sns)
+            published += 1
 
+        self.save_notify_state()
+        return published
+
+    def load_notify_state(self):
         try:
-            event = self.table.get_item(name)
+            with open(self.notify_state) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {}
+        self.alerts = [tuple(alert) for alert in state.get('deferred', [])]
+        return state.get('bucket', {})
 
-            if not Schema.Period in event:
-                return self.notify(name, Notification.ConfigError)
+    def save_notify_state(self):
+        # Rate limiter tokens and deferred alerts have to outlive each cron
+        # run for the limit to mean anything
+        if not self.notify_state or not self.notify_bucket:
+            return
+        directory = os.path.dirname(self.notify_state)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '%s.%d' % (self.notify_state, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'bucket': self.notify_bucket.state(),
+                       'deferred': self.alerts}, f)
+        os.rename(tmp, self.notify_state)
 
-            # If we're processing an older sqs message, we can just ignore it
-            if (Schema.LastSuccessTime in event and
-                    event_time < event[Schema.LastSuccessTime]):
-                return
+    def publish(self, subject, message, sns=None):
+        if sns is None:
+            sns = self.sns
+        self.metrics.inc('memon_published', topic=sns)
+        if self.outbox:
+            self.outbox.append(sns, subject, message, int(time.time()))
+            return
 
-            if (Schema.NextBlockTime in event and
-                    event[Schema.NextBlockTime] < event_time and
-                    event[Schema.Enabled]):
-                if event[Schema.ErrorCount] == 0:
-                    self.notify(name, Notification.Late, event)
-                else:
-                    self.notify(name, Notification.Up, event)
-
-            event[Schema.LastSuccessTime] = event_time
-            if event[Schema.Type] == PeriodType.Rolling:
-                event[Schema.LastBlockTime] = event_time
-                event[Schema.NextBlockTime] = (event_time +
-                                               int(event[Schema.Period]))
-            elif event[Schema.Type] == PeriodType.Fixed:
-                periods = 1
-                while (event_time > event[Schema.LastBlockTime]
-                       + int(event[Schema.Period]) * periods):
-                    periods += 1
-                event[Schema.LastBlockTime] = (event[Schema.LastBlockTime] +
-                                               int(event[Schema.Period]) *
-                                               periods)
-                event[Schema.NextBlockTime] = (event[Schema.LastBlockTime] +
-                                               int(event[Schema.Period]))
+        try:
+            self.sns_conn.publish(self.get_topic_arn(sns), message, subject)
+        except boto.exception.BotoServerError:
+            # retry once if the cached topic arn may have gone stale
+            if not self.invalidate_resource('topic', sns):
+                raise
+            self.sns_conn.publish(self.get_topic_arn(sns), message, subject)
+
+    def drain_outbox(self):
+        # Publish whatever is due from the outbox on a pool of worker
+        # threads. Returns the number of notifications attempted.
+        rows = self.outbox.pending(int(time.time()), self.outbox_workers * 10)
+        if not rows:
+            return 0
+
+        arns = {}
+        for topic in set(row[1] for row in rows):
+            try:
+                arns[topic] = self.get_topic_arn(topic)
+            except Exception as e:
+                arns[topic] = e
+        if self.outbox_pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.outbox_pool = ThreadPool(self.outbox_workers)
+        errors = self.outbox_pool.map(
+            lambda row: self.deliver(arns[row[1]], row), rows)
+
+        now = int(time.time())
+        for row, error in zip(rows, errors):
+            row_id, topic, subject, message, created, attempts = row
+            if error is None:
+                self.outbox.delivered(row_id)
+                self.outbox_stats['delivered'] += 1
+                self.outbox_stats['max_latency'] = max(
+                    self.outbox_stats['max_latency'], now - created)
             else:
-                return self.notify(name, Notification.ConfigError)
+                if self.debug:
+                    print 'Failed to publish %s: %s' % (subject, error)
+                if isinstance(error, boto.exception.BotoServerError):
+                    self.invalidate_resource('topic', topic)
+                self.outbox.retry(row_id, attempts + 1,
+                                  now + min(self.outbox_max_backoff,
+                                            2 ** attempts))
+                self.outbox_stats['failed'] += 1
+        if self.debug:
+            print ('Outbox delivered %(delivered)d, failed %(failed)d, '
+                   'max latency %(max_latency)ds' % (self.outbox_stats))
+        return len(rows)
+
+    def deliver(self, arn, row):
+        # Runs on an outbox worker thread, returns the error if any
+        if isinstance(arn, Exception):
+            return arn
+        try:
+            # boto connections aren't thread safe, so one per worker
+            if not hasattr(self.local, 'sns_conn'):
+                self.local.sns_conn = self.backend.publisher()
+            self.local.sns_conn.publish(arn, row[3], row[2])
+        except Exception as e:
+            return e
+        return None
+
+    def show_outbox(self):
+        pending, oldest = self.outbox.depth()
+        print 'Pending notifications: %d' % (pending)
+        if oldest is not None:
+            print 'Oldest: %ds ago' % (int(time.time()) - oldest)
+
+    report_windows = {'day': 86400, 'week': 7 * 86400, 'month': 30 * 86400}
+
+    def report(self, window='week', name=None):
+        rows = self.history.get_rollups().report(
+            self.now - self.report_windows[window], self.now, name)
+        print ('%-30s %6s %8s %16s %24s %12s' %
+               ('Name', 'Runs', 'Failures', 'Longest gap', 'Last failure',
+                'Availability'))
+        for row in rows:
+            last_failure = '-'
+            if row['last_failure']:
+                last_failure = time.ctime(row['last_failure'])
+            print ('%-30s %6d %8d %16s %24s %11.2f%%' %
+                   (row['name'], row['runs'], row['failures'],
+                    datetime.timedelta(seconds=row['longest_gap']),
+                    last_failure, 100 * row['availability']))
+
+    def record(self, name, event_time, max_attempts=3):
+        from boto.dynamodb.exceptions import DynamoDBThroughputExceededError
 
-            event[Schema.ErrorCount] = int(0)
-            event.save()
+        try:
+            event, notifications = self.record_event(name, event_time,
+                                                     max_attempts)
+        except DynamoDBThroughputExceededError:
+            # boto has already backed off and retried, so leave the
+            # heartbeat in sqs for the next poll rather than alerting
+            self.throttled.add(name)
+            return
         except Exception:
             self.notify(name, Notification.ConfigError)
+            return
+        for notification in notifications:
+            self.notify(name, notification, event)
+
+    def record_event(self, name, event_time, max_attempts=3):
+        # Applies a heartbeat and saves it, re-reading and trying again if
+        # the event changed since it was read. Returns the event and the
+        # notifications to send, without sending them.
+        from boto.dynamodb.exceptions import \
+            DynamoDBConditionalCheckFailedError
+
+        event = self.get_event(name)
+        for attempt in xrange(max_attempts):
+            expected = self.heartbeat_expected(event)
+            notifications = self.update_event(name, event, event_time)
+            if notifications is None:
+                return event, []
+            try:
+                self.save_event(event, expected)
+            except DynamoDBConditionalCheckFailedError:
+                # Changed since it was read, start again from the table
+                event = self.reload_event(name)
+                continue
+            self.metrics.inc('memon_events_recorded')
+            if self.history:
+                self.history.add(self.now, name, History.Heartbeat,
+                                 event[Schema.LastSuccessTime])
+            return event, notifications
+        raise Exception('Unable to save %s after %d attempts' %
+                        (name, max_attempts))
+
+    def record_concurrently(self, events):
+        # Each event name is recorded on a worker thread with conditional
+        # writes, while notifications are sent from this thread
+        from boto.dynamodb.exceptions import DynamoDBThroughputExceededError
+
+        if self.record_pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.record_pool = ThreadPool(self.record_workers,
+                                          self.init_record_worker)
+        names = sorted(events)
+        results = self.record_pool.map(
+            self.record_worker, [(name, events[name]) for name in names])
+        for name, result in zip(names, results):
+            if isinstance(result, DynamoDBThroughputExceededError):
+                self.throttled.add(name)
+                continue
+            if isinstance(result, Exception):
+                if self.debug:
+                    print result
+                self.notify(name, Notification.ConfigError)
+                continue
+            event, notifications = result
+            for notification in notifications:
+                self.notify(name, notification, event)
+
+    def init_record_worker(self):
+        self.backend.init_record_worker()
+
+    def record_worker(self, args):
+        # Runs on a record worker, returns the error if any
+        name, event_time = args
+        try:
+            return self.record_event(name, event_time)
+        except Exception as e:
+            return e
+
+    def record_batch(self, events):
+        # Bulk version of record: one BatchGetItem for every event in the
+        # batch and BatchWriteItem for the ones that changed
+        from boto.dynamodb.exceptions import \
+            DynamoDBConditionalCheckFailedError, \
+            DynamoDBThroughputExceededError
+
+        names = sorted(events)
+        if self.record_workers > 1:
+            self.record_concurrently(events)
+            return
+        if self.cache:
+            # Conditional writes can't be batched, but reads come from the
+            # cache so record is already down to one write per event
+            for name in names:
+                self.record(name, events[name])
+            return
+
+        try:
+            found = {}
+            for attrs in self.table.batch_get_item(list(names)):
+                found[attrs[Schema.Name]] = self.load_item(attrs)
+        except Exception as e:
+            if self.debug:
+                print e
+            for name in names:
+                self.record(name, events[name])
+            return
+
+        changed = []
+        for name in names:
+            try:
+                event = found[name]
+                expected = self.heartbeat_expected(event)
+                notifications = self.update_event(name, event, events[name])
+                if notifications is not None:
+                    changed.append((event, notifications, expected))
+            except Exception:
+                self.notify(name, Notification.ConfigError)
+
+        saved = None
+        if self.batch_writes and not self.shards:
+            try:
+                self.save_batch([event for event, _, _ in changed])
+                saved = [(event, notifications)
+                         for event, notifications, _ in changed]
+            except Exception as e:
+                if self.debug:
+                    print e
+        if saved is None:
+            # One UpdateItem of just the changed attributes at a time,
+            # conditional on no other heartbeat having been saved since
+            saved = []
+            for event, notifications, expected in changed:
+                name = event[Schema.Name]
+                try:
+                    self.save_event(event, expected)
+                    saved.append((event, notifications))
+                except DynamoDBConditionalCheckFailedError:
+                    if self.batch_saved(event):
+                        # part of the failed batch that was written, so
+                        # its notifications are still to send
+                        saved.append((event, notifications))
+                    else:
+                        # start again from the table
+                        self.record(name, events[name])
+                except DynamoDBThroughputExceededError:
+                    self.throttled.add(name)
+                except Exception:
+                    self.notify(name, Notification.ConfigError)
+        changed = saved
+
+        self.metrics.inc('memon_events_recorded', len(changed))
+        for event, notifications in changed:
+            if self.history:
+                self.history.add(self.now, event[Schema.Name],
+                                 History.Heartbeat,
+                                 event[Schema.LastSuccessTime])
+            for notification in notifications:
+                self.notify(event[Schema.Name], notification, event)
+
+    def save_batch(self, events):
+        # The new due index rows go ahead of the events, so however much of
+        # a failed batch was written they're in place, and rows left behind
+        # are dropped once they come due. The events are put back as they
+        # were read so they can still be saved one at a time.
+        read = [(event, event.get(Schema.Version),
+                 event.get(Schema.NotifyTime)) for event in events]
+        puts = []
+        deletes = []
+        for event in events:
+            event[Schema.Version] = (event.get(Schema.Version) or 0) + 1
+            event_puts, event_deletes = self.index_event(event)
+            puts.extend(event_puts)
+            deletes.extend(event_deletes)
+        puts.extend(events)
+        try:
+            self.batch_write(puts, deletes)
+        except Exception:
+            for event, version, notify_time in read:
+                for attr, value in ((Schema.Version, version),
+                                    (Schema.NotifyTime, notify_time)):
+                    if value is not None:
+                        event[attr] = value
+                    elif attr in event:
+                        del event[attr]
+            raise
+
+    def batch_write(self, puts, deletes):
+        self.backend.batch_write(puts, deletes)
+
+    def batch_saved(self, event):
+        # Whether the table holds the version and heartbeat this event was
+        # being saved with, ie a failed batch had already written it
+        from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
+
+        try:
+            current = self.reload_event(event[Schema.Name])
+        except DynamoDBKeyNotFoundError:
+            return False
+        return all(current.get(attr) == event.get(attr)
+                   for attr in (Schema.Version, Schema.LastSuccessTime))
+
+    def heartbeat_expected(self, event):
+        # The condition for saving a heartbeat: nothing else has recorded
+        # one since the event was read
+        return {Schema.LastSuccessTime:
+                event.get(Schema.LastSuccessTime, False)}
+
+    def update_event(self, name, event, event_time):
+        # Applies a heartbeat to the event in memory. Returns None if there's
+        # nothing to save, otherwise the notifications to send once saved.
+        if self.server_time:
+            event_time = self.now
+        else:
+            event_time = int(event_time)
+
+        if not Schema.Period in event:
+            # callers send the ConfigError, so workers never publish
+            raise Exception('%s has no Period' % (name))
+
+        # If we're processing an older sqs message, we can just ignore it
+        if (Schema.LastSuccessTime in event and
+                event_time < event[Schema.LastSuccessTime]):
+            return None
+
+        notifications = []
+        if (Schema.NextBlockTime in event and
+                event[Schema.NextBlockTime] < event_time and
+                event[Schema.Enabled]):
+            if event[Schema.ErrorCount] == 0:
+                notifications.append(Notification.Late)
+            else:
+                notifications.append(Notification.Up)
+
+        schedule = Schedule.for_event(event)
+        if schedule is None:
+            raise Exception('%s has an unknown Type %s' %
+                            (name, event.get(Schema.Type)))
+        event[Schema.LastSuccessTime] = event_time
+        (event[Schema.LastBlockTime],
+         event[Schema.NextBlockTime]) = schedule.advance(
+            event.get(Schema.LastBlockTime), event_time)
+
+        event[Schema.ErrorCount] = int(0)
+        return notifications
 
     def config(self, name, period, enabled, event_type=None,
-               description=None, initial_date=None, initial_time=None):
+               description=None, initial_date=None, initial_time=None,
+               schedule=None):
+        from boto.dynamodb.exceptions import DynamoDBKeyNotFoundError
+
         set_date = False
         date = datetime.datetime.now().date()
         if not initial_date is None:
@@ -268,8 +2949,18 @@ class MEMon(object):
                 date = date + datetime.timedelta(days=1)
             date = datetime.datetime.combine(date, initial_time)
             set_date = True
+        if schedule is not None:
+            # raises ValueError for an invalid expression
+            CronSchedule.parse(schedule)
+
         try:
-            event = self.table.get_item(hash_key=name)
+            event = self.load_item(self.table.get_item(hash_key=name))
+        except DynamoDBKeyNotFoundError as e:
+            if self.debug:
+                print e
+            event = None
+
+        if event is not None:
             if self.debug:
                 print 'Get Event %s' % event
             if not period is None:
@@ -280,17 +2971,11 @@ class MEMon(object):
                 event[Schema.Type] = event_type
             if not description is None:
                 event[Schema.Description] = description
-            if set_date:
-                event[Schema.NextBlockTime] = int(date.strftime('%s'))
-                event[Schema.LastBlockTime] = (int(date.strftime('%s')) -
-                                               event[Schema.Period])
-
-            event.save()
-        except boto.dynamodb.exceptions.DynamoDBValidationError as v_err:
-            raise v_err
-        except Exception as e:
-            if self.debug:
-                print e
+            if schedule is not None:
+                event[Schema.Schedule] = schedule
+            event[Schema.Version] = (event.get(Schema.Version) or 0) + 1
+            new = False
+        else:
             if not period:
                 raise Exception('Period is required for new events')
             if not event_type:
@@ -301,29 +2986,313 @@ class MEMon(object):
                 Schema.Period: period,
                 Schema.Enabled: enabled,
                 Schema.ErrorCount: 0,
-                Schema.Type: event_type
+                Schema.Type: event_type,
+                Schema.Version: 1
             }
             if description:
                 data[Schema.Description] = description
-            if set_date:
-                data[Schema.NextBlockTime] = int(date.strftime('%s'))
-                data[Schema.LastBlockTime] = int(date.strftime('%s')) - period
+            if schedule:
+                data[Schema.Schedule] = schedule
 
             print data
 
             #self.table.put_item(data)
-            item = self.table.new_item(hash_key=name, attrs=data)
-            item.put()
+            event = self.table.new_item(hash_key=name, attrs=data)
+            new = True
+
+        is_cron = event.get(Schema.Type) == PeriodType.Cron
+        if is_cron and not event.get(Schema.Schedule):
+            raise Exception('Schedule is required for cron events')
+        if set_date:
+            self.schedule_start(event, int(date.strftime('%s')))
+        elif is_cron and (schedule is not None or event_type is not None or
+                          Schema.NextBlockTime not in event):
+            self.schedule_start(event, self.now)
+
+        self.write_indexed(event, event.put if new else event.save)
 
         if self.debug:
             self.show(name)
 
-    def main(self):
+    # The attributes config sets, the rest are state kept by poll
+    config_attrs = (Schema.Period, Schema.Enabled, Schema.Type,
+                    Schema.Description, Schema.Schedule)
+
+    def event_config(self, attrs):
+        # An event's config as imported and exported
+        config = {Schema.Name: attrs[Schema.Name],
+                  Schema.Enabled: bool(attrs.get(Schema.Enabled, True))}
+        for attr in self.config_attrs:
+            if attr != Schema.Enabled and attrs.get(attr):
+                config[attr] = attrs[attr]
+        if Schema.Period in config:
+            config[Schema.Period] = int(config[Schema.Period])
+        return config
+
+    def read_config_file(self, path):
+        with open(path) as f:
+            if not path.endswith(('.yaml', '.yml')):
+                return json.load(f)
+            try:
+                import yaml
+            except ImportError:
+                raise Exception('PyYAML is required for %s' % (path))
+            return yaml.safe_load(f) or []
+
+    def config_import(self, path, prune=False):
+        # Applies a list of event configs in one pass: the table is scanned
+        # once and only the events that differ are written, in BatchWriteItem
+        # calls. With prune, events missing from the list are deleted.
+        desired = {}
+        for attrs in self.read_config_file(path):
+            name = attrs.get(Schema.Name)
+            if not name:
+                raise Exception('Event without a Name in %s' % (path))
+            if name in desired:
+                raise Exception('%s is listed more than once' % (name))
+            unknown = set(attrs) - set((Schema.Name,) + self.config_attrs)
+            if unknown:
+                raise Exception('%s has unknown attributes: %s' %
+                                (name, ', '.join(sorted(unknown))))
+            if not attrs.get(Schema.Period) or not attrs.get(Schema.Type):
+                raise Exception('%s needs a Period and Type' % (name))
+            if attrs[Schema.Type] not in (PeriodType.Fixed,
+                                          PeriodType.Rolling,
+                                          PeriodType.Cron):
+                raise Exception('%s has an unknown Type %s' %
+                                (name, attrs[Schema.Type]))
+            if attrs[Schema.Type] == PeriodType.Cron:
+                if not attrs.get(Schema.Schedule):
+                    raise Exception('Schedule is required for cron events')
+                # raises ValueError for an invalid expression
+                CronSchedule.parse(attrs[Schema.Schedule])
+            desired[name] = self.event_config(attrs)
+
+        current = dict((event[Schema.Name], event)
+                       for event in self.scan_events())
+        created = []
+        updated = []
+        for name, config in sorted(desired.items()):
+            event = current.pop(name, None)
+            if event is None:
+                event = self.table.new_item(hash_key=name,
+                                            attrs={Schema.ErrorCount: 0})
+                created.append(event)
+            elif self.event_config(event) == config:
+                continue
+            else:
+                updated.append(event)
+            rescheduled = (event.get(Schema.Type) != config[Schema.Type] or
+                           event.get(Schema.Schedule) !=
+                           config.get(Schema.Schedule) or
+                           Schema.NextBlockTime not in event)
+            for attr in self.config_attrs:
+                if attr in config:
+                    event[attr] = config[attr]
+                elif attr in event:
+                    del event[attr]
+            event[Schema.Enabled] = int(config[Schema.Enabled])
+            if config[Schema.Type] == PeriodType.Cron and rescheduled:
+                self.schedule_start(event, self.now)
+
+        self.save_batch(created + updated)
+        deleted = []
+        if prune:
+            deleted = sorted(current)
+            self.batch_write([], [(self.table, name) for name in deleted])
+        if self.cache:
+            for event in created + updated:
+                self.cache.put(event, self.notify_time(event))
+            for name in deleted:
+                self.cache.delete(name)
+        print ('Created %d, updated %d, deleted %d and left %d events '
+               'unchanged' % (len(created), len(updated), len(deleted),
+                              len(desired) - len(created) - len(updated)))
+
+    def config_export(self, path='-'):
+        # Every event's config, in the format config_import reads
+        configs = sorted((self.event_config(event)
+                          for event in self.scan_events()),
+                         key=lambda config: config[Schema.Name])
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            text = yaml.safe_dump(configs, default_flow_style=False)
+        else:
+            text = json.dumps(configs, indent=2, sort_keys=True,
+                              separators=(',', ': ')) + '\n'
+        if path == '-':
+            sys.stdout.write(text)
+        else:
+            with open(path, 'w') as f:
+                f.write(text)
+
+    def schedule_start(self, event, start):
+        # First expected run of a newly (re)scheduled event
+        next_block = Schedule.for_event(event).first(start)
+        event[Schema.NextBlockTime] = next_block
+        event[Schema.LastBlockTime] = next_block - event[Schema.Period]
+
+    @contextlib.contextmanager
+    def poll_lock(self):
+        # Yields whether this process holds the lock on lock_path, which is
+        # released when the process exits however it exits
+        if not self.lock_path:
+            yield True
+            return
+        directory = os.path.dirname(self.lock_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open(self.lock_path, 'a')
+        try:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                yield False
+                return
+            yield True
+        finally:
+            f.close()
+
+    def check_capacity(self):
+        # Reports the tables that needed more than their provisioned
+        # capacity this cycle, having waited for it or been throttled
+        for (table, kind), waited in sorted(self.capacity.waited.items()):
+            self.metrics.set('memon_capacity_wait_seconds', waited,
+                             table=table, kind=kind)
+            self.metrics.set('memon_capacity_short', 1, table=table,
+                             kind=kind)
+            print ('DynamoDB table %s is short of %s capacity, requests '
+                   'waited %.1fs for it' % (table, kind, waited))
+        throttled = sum(value for (name, labels), value
+                        in self.metrics.values.items()
+                        if name == 'memon_throttle_retries')
+        if throttled:
+            print ('DynamoDB throttled %d requests, the provisioned '
+                   'capacity needs raising' % (throttled))
+
+    def poll_cycle(self, poll_count):
+        self.metrics.reset()
+        self.capacity.reset()
+        self.metrics.set('memon_cycle_timestamp_seconds', self.now)
+        failed = 1
+        try:
+            with self.metrics.timer('memon_cycle_seconds', phase='total'):
+                if self.cache:
+                    with self.metrics.timer('memon_cycle_seconds',
+                                            phase='refresh_cache'):
+                        self.refresh_cache()
+                with self.metrics.timer('memon_cycle_seconds', phase='poll'):
+                    self.poll(poll_count)
+                with self.metrics.timer('memon_cycle_seconds',
+                                        phase='notify_down_events'):
+                    if self.shards:
+                        self.owned_shards = self.claim_shards()
+                    self.notify_down_events()
+                with self.metrics.timer('memon_cycle_seconds',
+                                        phase='flush_alerts'):
+                    self.flush_alerts()
+                if self.history:
+                    with self.metrics.timer('memon_cycle_seconds',
+                                            phase='history'):
+                        self.history.write()
+                        self.history.expire(self.now)
+                self.check_capacity()
+            failed = 0
+        finally:
+            self.metrics.set('memon_cycle_failed', failed)
+            if self.metrics_path:
+                self.metrics.write(self.metrics_path, self.metrics_format)
+
+    def serve(self, poll_count):
+        # Long running alternative to running poll from cron every minute.
+        # Connections, tables and caches are kept between cycles, SIGHUP
+        # reloads them and SIGTERM/SIGINT stop after the current cycle.
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        # a long poll shouldn't hold up the next cycle
+        self.wait_time = min(self.wait_time, self.interval)
+        if self.poll_budget:
+            self.poll_budget = min(self.poll_budget, self.interval)
+
+        drainer = None
+        if self.outbox:
+            drainer = OutboxDrainer(self)
+            drainer.start()
+        while not self.stopping.is_set():
+            started = time.time()
+            self.now = int(started)
+            try:
+                if self.reloading:
+                    self.reload()
+                self.poll_cycle(poll_count)
+            except Exception as e:
+                print e
+                if (isinstance(e, boto.exception.BotoServerError) and
+                        self.resources):
+                    self.resources.invalidate()
+            if self.debug:
+                print 'Cycle took %.2fs' % (time.time() - started)
+            self.stopping.wait(max(0, self.interval -
+                                   (time.time() - started)))
+        if self.shards:
+            try:
+                self.release_shards()
+            except Exception as e:
+                print e
+        if drainer:
+            drainer.stop(self.outbox_timeout)
+
+    def agent(self, udp=None, http=None):
+        # Forward heartbeats received locally until SIGTERM/SIGINT
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        agent = Agent(self)
+        if udp:
+            agent.listen_udp(parse_address(udp))
+        if http:
+            agent.listen_http(parse_address(http))
+        if not agent.servers:
+            raise Exception('Missing --udp or --http address')
+        agent.run(self.interval)
+
+    def handle_stop(self, signum, frame):
+        self.stopping.set()
+
+    def handle_reload(self, signum, frame):
+        # picked up at the start of the next cycle
+        self.reloading = True
+
+    def reload(self):
+        # Look up the AWS resources again and pick up any event config
+        # changes straight away
+        self.reloading = False
+        if self.resources:
+            self.resources.invalidate()
+        self.load_tables()
+        if self.record_pool is not None:
+            # the record workers have copies of the old tables
+            self.record_pool.close()
+            self.record_pool = None
+        if self.cache:
+            self.refresh_cache(True)
+        print 'Reloaded'
+
+    def main(self, argv=None):
 
         parser = argparse.ArgumentParser(description='Missing Event Monitor')
         parser.add_argument('--region',
                             default='us-east-1',
                             help=('Region to use (default: %(default)s)'))
+        parser.add_argument('--backend',
+                            default='aws',
+                            choices=['aws', 'sqlite'],
+                            help=('Where events, heartbeats and notifications '
+                                  'are kept (default: %(default)s)'))
+        parser.add_argument('--database',
+                            default=os.path.expanduser('~/.memon/memon.db'),
+                            help=('SQLite backend database '
+                                  '(default: %(default)s)'))
         parser.add_argument('--queue',
                             default=self.queue,
                             help='MEMon SQS Name (default: %(default)s)')
@@ -331,6 +3300,163 @@ class MEMon(object):
                             default=self.table_name,
                             help=('MEMon DynamoDb Table Name '
                                   '(default: %(default)s)'))
+        parser.add_argument('--due-table',
+                            default=self.due_table_name,
+                            help=('MEMon DynamoDb due index table name '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--due-buckets',
+                            type=int,
+                            default=self.due_buckets,
+                            help=('Number of due index hash buckets, must '
+                                  'match on every host '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--shards',
+                            type=int,
+                            default=self.shards,
+                            help=('Share down event checks between pollers '
+                                  'by leasing this many shards, best set the '
+                                  'same as --due-buckets (default: off)'))
+        parser.add_argument('--lease-table',
+                            default=self.lease_table_name,
+                            help=('MEMon DynamoDb shard lease table name '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--lease-ttl',
+                            type=int,
+                            default=self.lease_ttl,
+                            help=('Seconds a poller keeps its shards without '
+                                  'polling (default: %(default)s)'))
+        parser.add_argument('--poller-id',
+                            default=self.poller_id,
+                            help=('Name this poller holds leases under, must '
+                                  'be unique (default: %(default)s)'))
+        parser.add_argument('--batch-writes',
+                            default=False,
+                            action='store_true',
+                            help=('Save heartbeats with BatchWriteItem, in '
+                                  'fewer requests but rewriting whole events '
+                                  'unconditionally'))
+        parser.add_argument('--record-workers',
+                            type=int,
+                            default=self.record_workers,
+                            help=('Threads recording heartbeats for different '
+                                  'events at once, with conditional writes '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--read-capacity',
+                            type=int,
+                            default=self.read_capacity,
+                            help=('Init only: provisioned read units of the '
+                                  'tables created (default: %(default)s)'))
+        parser.add_argument('--write-capacity',
+                            type=int,
+                            default=self.write_capacity,
+                            help=('Init only: provisioned write units of the '
+                                  'tables created (default: %(default)s)'))
+        parser.add_argument('--capacity-burst',
+                            type=int,
+                            default=self.capacity.burst,
+                            help=('Seconds of unused provisioned capacity '
+                                  'requests may burst into before they are '
+                                  'paced, 0 to not pace (default: '
+                                  '%(default)s)'))
+        parser.add_argument('--scan-segments',
+                            type=int,
+                            default=self.scan_segments,
+                            help=('Segments to scan the event table in, in '
+                                  'parallel (default: %(default)s)'))
+        parser.add_argument('--scan-capacity',
+                            type=float,
+                            default=self.scan_capacity,
+                            help=('Read capacity units a second a parallel '
+                                  'scan may use across all its segments '
+                                  '(default: unlimited)'))
+        parser.add_argument('--cache',
+                            default=None,
+                            help=('Local SQLite snapshot of the event table '
+                                  'used by poll and config (default: off)'))
+        parser.add_argument('--cache-refresh',
+                            type=int,
+                            default=self.cache_refresh,
+                            help=('Seconds between incremental cache '
+                                  'refreshes (default: %(default)s)'))
+        parser.add_argument('--resource-cache',
+                            default=os.path.expanduser(
+                                '~/.memon/resources.json'),
+                            help=('File caching the topic arn, queue url and '
+                                  'table descriptions between runs, empty to '
+                                  'disable (default: %(default)s)'))
+        parser.add_argument('--resource-ttl',
+                            type=int,
+                            default=self.resource_ttl,
+                            help=('Seconds to trust cached resources '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--metrics',
+                            default=None,
+                            help=('Write metrics for each poll cycle to this '
+                                  'file (default: off)'))
+        parser.add_argument('--metrics-format',
+                            default=self.metrics_format,
+                            choices=['prometheus', 'json'],
+                            help=('prometheus textfile, replaced each cycle, '
+                                  'or json lines appended each cycle '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--spool',
+                            default=None,
+                            help=('Send only appends heartbeats to this file, '
+                                  'flush sends them to sqs in packed batches '
+                                  '(default: off)'))
+        parser.add_argument('--history',
+                            default=None,
+                            help=('Directory that poll appends every '
+                                  'heartbeat and notification to, for '
+                                  'reporting (default: off)'))
+        parser.add_argument('--history-days',
+                            type=int,
+                            default=90,
+                            help=('Days of history to keep '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--report-window',
+                            default='week',
+                            choices=sorted(self.report_windows),
+                            help=('Report only: Period to report on '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--outbox',
+                            default=None,
+                            help=('Local SQLite outbox that notifications '
+                                  'are queued in and published from by a '
+                                  'pool of workers (default: off)'))
+        parser.add_argument('--outbox-workers',
+                            type=int,
+                            default=self.outbox_workers,
+                            help=('Outbox publishing threads '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--outbox-timeout',
+                            type=int,
+                            default=self.outbox_timeout,
+                            help=('Seconds poll waits for the outbox to '
+                                  'drain before leaving the rest for the '
+                                  'next run (default: %(default)s)'))
+        parser.add_argument('--digest',
+                            default=False,
+                            action='store_true',
+                            help=('Poll only: send the alerts from each poll '
+                                  'as one digest per topic'))
+        parser.add_argument('--rate-limit',
+                            type=float,
+                            default=0,
+                            help=('Poll only: max digests per minute, '
+                                  'implies --digest (default: off)'))
+        parser.add_argument('--rate-burst',
+                            type=int,
+                            default=5,
+                            help=('Poll only: digests allowed in a burst '
+                                  'over the rate limit (default: '
+                                  '%(default)s)'))
+        parser.add_argument('--rate-state',
+                            default=os.path.expanduser(
+                                '~/.memon/notify.json'),
+                            help=('File keeping the rate limit and deferred '
+                                  'alerts between runs '
+                                  '(default: %(default)s)'))
         parser.add_argument('--sns',
                             default=self.sns,
                             help='MEMon SNS Topic Name (default: %(default)s)')
@@ -359,7 +3485,40 @@ class MEMon(object):
         parser.add_argument('--poll-count',
                             type=int,
                             default=3,
-                            help='Number of times to poll in period')
+                            help=('Number of times to poll in period, '
+                                  'without --poll-budget'))
+        parser.add_argument('--poll-budget',
+                            type=int,
+                            default=0,
+                            help=('Seconds poll may spend draining the '
+                                  'queue until it is empty, eg 50 from '
+                                  'cron, 0 to poll --poll-count times '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--lock',
+                            default=os.path.expanduser('~/.memon/poll.lock'),
+                            help=('Lock file held while polling, so polls '
+                                  'never overlap (default: %(default)s)'))
+        parser.add_argument('--interval',
+                            type=int,
+                            default=self.interval,
+                            help=('Serve and agent only: seconds between '
+                                  'poll cycles or forwarding heartbeats '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--udp',
+                            default='127.0.0.1:8126',
+                            help=('Agent only: udp address to receive event '
+                                  'names on, empty to disable '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--http',
+                            default='127.0.0.1:8126',
+                            help=('Agent only: http address to receive '
+                                  'POST /NAME on, empty to disable '
+                                  '(default: %(default)s)'))
+        parser.add_argument('--wait-time',
+                            type=int,
+                            default=self.wait_time,
+                            help=('Poll only: SQS long poll wait in seconds, '
+                                  '0-20 (default: %(default)s)'))
 
         parser.add_argument('--period',
                             type=int,
@@ -378,8 +3537,32 @@ class MEMon(object):
                             default=None,
                             help=('Config only: '
                                   'Optional description for event'))
+        parser.add_argument('--import',
+                            dest='import_path',
+                            default=None,
+                            help=('Config only: apply the events in this '
+                                  'JSON or YAML file, writing only the ones '
+                                  'that changed'))
+        parser.add_argument('--export',
+                            dest='export_path',
+                            nargs='?',
+                            const='-',
+                            default=None,
+                            help=('Config only: write every event to this '
+                                  'file, or stdout, in the --import format'))
+        parser.add_argument('--prune',
+                            default=False,
+                            action='store_true',
+                            help=('Config only: --import deletes the events '
+                                  'missing from the file'))
+        parser.add_argument('--schedule',
+                            default=None,
+                            help=('Config only: cron expression (minute hour '
+                                  'day month weekday, local time) of when '
+                                  'cron type events should have run by'))
         parser.add_argument('--type',
-                            choices=[PeriodType.Fixed, PeriodType.Rolling],
+                            choices=[PeriodType.Fixed, PeriodType.Rolling,
+                                     PeriodType.Cron],
                             default=None,
                             help='Config only')
         parser.add_argument('--enabled',
@@ -396,44 +3579,126 @@ class MEMon(object):
                             help='Show only: Only show events in error')
         parser.set_defaults(enabled=True)
         parser.add_argument('action',
-                            choices=['init', 'send', 'poll',
-                                     'config', 'show', 'version'],
+                            choices=['init', 'send', 'flush', 'agent', 'poll',
+                                     'serve', 'config', 'show', 'reindex',
+                                     'outbox', 'report', 'version'],
                             help='Action to perform')
         parser.add_argument('name',
                             nargs='?',
                             help='Event name (required for send and config)')
 
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
+        self.region = args.region
         self.table_name = args.table
+        self.due_table_name = args.due_table
+        self.due_buckets = args.due_buckets
+        self.shards = args.shards
+        self.record_workers = args.record_workers
+        self.batch_writes = args.batch_writes
+        self.scan_segments = args.scan_segments
+        self.read_capacity = args.read_capacity
+        self.write_capacity = args.write_capacity
+        self.capacity.burst = args.capacity_burst
+        self.scan_capacity = args.scan_capacity
+        self.lease_table_name = args.lease_table
+        self.lease_ttl = args.lease_ttl
+        self.poller_id = args.poller_id
+        self.cache_refresh = args.cache_refresh
+        self.resource_ttl = args.resource_ttl
+        self.outbox_workers = args.outbox_workers
+        self.outbox_timeout = args.outbox_timeout
+        if args.outbox:
+            self.outbox = Outbox(args.outbox)
+        self.digest = args.digest or args.rate_limit > 0
+        if args.rate_limit > 0:
+            self.notify_state = args.rate_state
+            bucket = self.load_notify_state()
+            self.notify_bucket = TokenBucket(args.rate_limit / 60.0,
+                                             args.rate_burst, **bucket)
+        if args.resource_cache:
+            self.resources = ResourceCache(args.resource_cache,
+                                           self.resource_ttl)
+        if args.cache:
+            self.cache = EventCache(args.cache)
+        if args.spool:
+            self.spool = Spool(args.spool)
+        if args.history:
+            self.history = History(args.history, args.history_days)
+        self.metrics_path = args.metrics
+        self.metrics_format = args.metrics_format
+        if args.backend == 'sqlite':
+            self.backend = SqliteBackend(args.database, echo=True)
         self.queue = args.queue
         self.sns = args.sns
         self.sns_email = args.sns_email
         self.debug = args.debug
         self.max_notify_count = args.max_notify_count
-
-        # set region
-        self.db = boto.dynamodb.connect_to_region(args.region)
-        self.sqs = boto.sqs.connect_to_region(args.region)
-        self.sns_conn = boto.sns.connect_to_region(args.region)
+        self.wait_time = args.wait_time
+        self.poll_budget = args.poll_budget
+        self.lock_path = args.lock
+        self.interval = args.interval
 
         if args.action == 'init':
-            self.aws_init()
+            self.backend.init()
             sys.exit(0)
 
-        # get_table needs to be after init or init will fail
-        self.table = self.db.get_table(self.table_name)
+        try:
+            self.run(args)
+        except boto.exception.BotoServerError:
+            # Something cached may be stale, look everything up next run
+            if self.resources:
+                self.resources.invalidate()
+            raise
+
+    def load_tables(self):
+        self.table = self.get_table(self.table_name)
+        if self.shards:
+            self.lease_table = self.get_table(self.lease_table_name)
+        self.due_table = self.backend.due_table(self.due_table_name)
+
+    def run(self, args):
+        # get_table needs to be after init or init will fail, and send
+        # and the heartbeat forwarders don't need the tables at all
+        if args.action not in ('send', 'flush', 'agent', 'outbox', 'version'):
+            self.load_tables()
 
         if args.action == 'send':
             if not args.name:
                 raise Exception('Missing event name')
 
             self.send(args.name)
-        elif args.action == 'poll':
-            for i in xrange(args.poll_count):
-                if self.debug:
-                    print "Poll attempt %d" % (i)
-                self.poll()
-            self.notify_down_events()
+        elif args.action == 'flush':
+            if not self.spool:
+                raise Exception('Missing --spool')
+            self.flush()
+        elif args.action == 'agent':
+            self.agent(args.udp, args.http)
+        elif args.action in ('poll', 'serve'):
+            with self.poll_lock() as locked:
+                if not locked:
+                    print 'Another poll holds %s, skipping' % (self.lock_path)
+                elif args.action == 'serve':
+                    self.serve(args.poll_count)
+                else:
+                    drainer = None
+                    if self.outbox:
+                        drainer = OutboxDrainer(self)
+                        drainer.start()
+                    self.poll_cycle(args.poll_count)
+                    if drainer:
+                        drainer.stop(self.outbox_timeout)
+        elif args.action == 'outbox':
+            if not self.outbox:
+                raise Exception('Missing --outbox')
+            self.show_outbox()
+        elif args.action == 'report':
+            if not self.history:
+                raise Exception('Missing --history')
+            self.report(args.report_window, args.name)
+        elif args.action == 'config' and args.import_path:
+            self.config_import(args.import_path, args.prune)
+        elif args.action == 'config' and args.export_path:
+            self.config_export(args.export_path)
         elif args.action == 'config':
             if not args.name:
                 raise Exception('Missing event name')
@@ -445,9 +3710,12 @@ class MEMon(object):
                         args.type,
                         args.description,
                         args.initial_date,
-                        args.initial_time)
+                        args.initial_time,
+                        args.schedule)
         elif args.action == 'show':
             self.show(args.name, args.only_errors)
+        elif args.action == 'reindex':
+            self.reindex()
         elif args.action == 'version':
             print "MEMon Version %s" % (MEMON_VERSION)
             sys.exit(0)
@@ -1,14 +1,39 @@
 import unittest
 import boto
 import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+from memon import Agent
+from memon import CapacityLimiter
+from memon import CronSchedule
+from memon import EventCache
+from memon import History
+from memon import FixedSchedule
 from memon import MEMon
+from memon import Metrics
+from memon import ResourceCache
+from memon import Spool
+from memon import SqliteBackend
+from memon import TokenBucket
+from memon import Notification
+from memon import Outbox
+from memon import OutboxDrainer
 from memon import PeriodType
 from moto import mock_sns
 from moto import mock_dynamodb
+from moto import mock_sqs
 from boto import kms
 import httpretty
 import sure
 from six.moves.urllib.parse import parse_qs
+from StringIO import StringIO
 from boto.dynamodb2.fields import HashKey
 from boto.dynamodb2.table import Table
 from boto.dynamodb2.table import Item
@@ -117,6 +142,45 @@ class TestMEMon(unittest.TestCase):
                                 "http",
                                 "http://example.com/foobar")
 
+    def initDueTable(self):
+        from ddbmock.database.db import dynamodb
+        from ddbmock.database.table import Table
+        from ddbmock.database.key import PrimaryKey
+
+        dynamodb.data[self.memon.due_table_name] = Table(
+            self.memon.due_table_name,
+            self.TABLE_RT,
+            self.TABLE_WT,
+            PrimaryKey(u'Bucket', u'N'),
+            PrimaryKey(u'Due', u'S'))
+        self.memon.due_table = self.db.get_table(self.memon.due_table_name)
+
+    def initLeaseTable(self, memon):
+        from ddbmock.database.db import dynamodb
+        from ddbmock.database.table import Table
+        from ddbmock.database.key import PrimaryKey
+
+        if memon.lease_table_name not in dynamodb.data:
+            dynamodb.data[memon.lease_table_name] = Table(
+                memon.lease_table_name,
+                self.TABLE_RT,
+                self.TABLE_WT,
+                PrimaryKey(u'Name', u'S'),
+                None)
+        memon.lease_table = self.db.get_table(memon.lease_table_name)
+
+    def getDueKeys(self):
+        return sorted(row['Due'] for row in self.memon.due_table.scan())
+
+    def initSqs(self):
+        self.memon.sqs = boto.connect_sqs()
+        self.memon.wait_time = 0
+        return self.memon.sqs.create_queue(self.memon.queue)
+
+    def sendAt(self, name, event_time):
+        self.memon.now = event_time
+        self.memon.send(name)
+
     def getPostMessage(self):
         last_request = httpretty.last_request()
         last_request.method.should.equal("POST")
@@ -387,6 +451,28 @@ class TestMEMon(unittest.TestCase):
         # empty body request - presumably from the sns subscription
         self.assertEqual(0, len(httpretty.last_request().body))
 
+    def test_show(self):
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.table.new_item(hash_key='Down', attrs=dict(
+            self.DOWN, ErrorCount=2)).put()
+
+        def show(*args, **kwargs):
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                self.memon.show(*args, **kwargs)
+                return sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+        self.assertIn('\nDown\n', show(error_only=True))
+        self.assertNotIn('\nRolling\n', show(error_only=True))
+
+        def scan(*args, **kwargs):
+            raise Exception('show NAME should not scan')
+        self.table.scan = scan
+        self.assertIn('\nRolling\n', show('Rolling'))
+        self.assertEquals('\n\n', show('Rolling', error_only=True))
+        self.assertEquals('\n\n', show('Missing'))
+
     @mock_sns
     def test_down_notify(self):
         self.initSns()
@@ -480,6 +566,1568 @@ class TestMEMon(unittest.TestCase):
 
         self.assertEqual(0, len(httpretty.last_request().body))
 
+    @mock_sqs
+    @mock_sns
+    def test_poll_batch_delete(self):
+        self.initSns()
+        q = self.initSqs()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.table.new_item(hash_key='Fixed', attrs=self.FIXED).put()
+
+        self.sendAt('Rolling', 6)
+        self.sendAt('Fixed', 7)
+        self.sendAt('Rolling', 8)
+
+        self.assertEquals(3, self.memon.poll())
+        self.assertEquals(0, self.memon.delete_failures)
+        self.assertEquals(0, q.count())
+
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(8, event['LastSuccessTime'])
+        event = self.table.get_item(hash_key='Fixed')
+        self.assertEquals(7, event['LastSuccessTime'])
+
+    @mock_sqs
+    @mock_sns
+    def test_poll_coalesce(self):
+        self.initSns()
+        self.initSqs()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+
+        self.sendAt('Rolling', 8)
+        self.sendAt('Rolling', 6)
+        self.sendAt('Rolling', 7)
+
+        recorded = []
+        update_event = self.memon.update_event
+        self.memon.update_event = (
+            lambda name, event, time: (recorded.append(name) or
+                                       update_event(name, event, time)))
+
+        self.assertEquals(3, self.memon.poll(3))
+        self.assertEquals(['Rolling'], recorded)
+
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(8, event['LastSuccessTime'])
+
+    def initSpool(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.memon.spool = Spool(os.path.join(directory, 'spool'))
+        return self.memon.spool
+
+    @mock_sqs
+    @mock_sns
+    def test_spool_flush(self):
+        self.initSns()
+        q = self.initSqs()
+        self.initSpool()
+        self.memon.pack_size = 2
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.table.new_item(hash_key='Fixed', attrs=self.FIXED).put()
+        self.table.new_item(hash_key='Blank', attrs=self.BLANK).put()
+
+        self.sendAt('Rolling', 6)
+        self.sendAt('Fixed', 7)
+        self.sendAt('Rolling', 8)
+        self.sendAt('Blank', 9)
+        self.assertEquals(0, q.count())
+
+        self.assertEquals(4, self.memon.flush())
+        self.assertEquals(2, q.count())
+        self.assertEquals(0, self.memon.flush())
+
+        self.assertEquals(2, self.memon.poll())
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(8, event['LastSuccessTime'])
+        event = self.table.get_item(hash_key='Fixed')
+        self.assertEquals(7, event['LastSuccessTime'])
+
+    @mock_sqs
+    def test_spool_failed_flush(self):
+        q = self.initSqs()
+        spool = self.initSpool()
+        self.sendAt('Rolling', 6)
+
+        def write_batch(*args, **kwargs):
+            raise Exception('sqs unavailable')
+        self.memon.get_queue = lambda: q
+        q.write_batch = write_batch
+        self.assertRaises(Exception, self.memon.flush)
+
+        # sends carry on spooling while a flush is pending
+        self.sendAt('Fixed', 7)
+        del q.write_batch
+        self.assertEquals(2, self.memon.flush())
+        self.assertEquals(2, q.count())
+        self.assertFalse(os.path.exists(spool.path))
+        self.assertFalse(os.path.exists(spool.flush_path))
+
+    def test_agent_listen(self):
+        agent = Agent(self.memon)
+        self.addCleanup(agent.shutdown)
+        udp = agent.listen_udp(('127.0.0.1', 0))
+        http = agent.listen_http(('127.0.0.1', 0))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.sendto('Rolling\nFixed\n', udp.server_address)
+        sock.close()
+        response = urllib2.urlopen(urllib2.Request(
+            'http://127.0.0.1:%d/Blank%%20Event' % (http.server_address[1]),
+            data=''))
+        self.assertEquals(204, response.getcode())
+
+        for i in xrange(100):
+            if len(agent.events) == 3:
+                break
+            time.sleep(0.01)
+        self.assertEquals(['Blank Event', 'Fixed', 'Rolling'],
+                          sorted(agent.events))
+
+    @mock_sqs
+    @mock_sns
+    def test_agent_flush(self):
+        self.initSns()
+        q = self.initSqs()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        agent = Agent(self.memon)
+        agent.add('Rolling', 8)
+        agent.add('Rolling', 6)
+
+        send_batch = self.memon.send_batch
+
+        def fail(bodies):
+            raise Exception('sqs unavailable')
+        self.memon.send_batch = fail
+        self.assertRaises(Exception, agent.flush)
+        agent.add('Rolling', 7)
+        self.memon.send_batch = send_batch
+
+        self.assertEquals(1, agent.flush())
+        self.assertEquals(0, agent.flush())
+        self.assertEquals(1, q.count())
+        self.assertEquals(1, self.memon.poll())
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(8, event['LastSuccessTime'])
+
+    def initSqliteBackend(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        memon = MEMon()
+        memon.backend = SqliteBackend(path)
+        memon.server_time = False
+        memon.load_tables()
+        return memon
+
+    def test_sqlite_backend(self):
+        memon = self.initSqliteBackend()
+        memon.now = 0
+        memon.config('Fixed', 5, True, PeriodType.Fixed, 'desc',
+                     datetime.date(2010, 1, 1), None)
+        start = int(datetime.date(2010, 1, 1).strftime('%s'))
+
+        memon.now = start + 3
+        memon.send('Fixed')
+        self.assertEquals(1, memon.get_queue().count())
+        self.assertEquals(1, memon.poll())
+        self.assertEquals(0, memon.get_queue().count())
+        event = memon.table.get_item('Fixed')
+        self.assertEquals(start + 3, event['LastSuccessTime'])
+        self.assertEquals(start + 10, event['NotifyTime'])
+
+        def scan(*args, **kwargs):
+            raise Exception('notify_down_events should not scan')
+        memon.table.scan = scan
+        memon.now = start + 9
+        memon.notify_down_events()
+        notifications = memon.backend.notifications(memon.sns)
+        self.assertEquals(['[MEMon] Late: Fixed'],
+                          [subject for subject, message in notifications])
+        memon.now = start + 10
+        memon.notify_down_events()
+        notifications = memon.backend.notifications(memon.sns)
+        self.assertEquals(2, len(notifications))
+        self.assertIn('Down: Fixed', notifications[1][1])
+        event = memon.table.get_item('Fixed')
+        self.assertEquals(1, event['ErrorCount'])
+        self.assertEquals(start + 15, event['NotifyTime'])
+
+    def test_sqlite_backend_conditional_put(self):
+        from boto.dynamodb.exceptions import \
+            DynamoDBConditionalCheckFailedError
+        memon = self.initSqliteBackend()
+        event = memon.table.new_item(hash_key='Rolling', attrs=self.ROLLING)
+        event['Version'] = 1
+        event.put(expected_value={'Version': False})
+        self.assertRaises(DynamoDBConditionalCheckFailedError, event.put,
+                          expected_value={'Version': False})
+        event['Version'] = 2
+        event.put(expected_value={'Version': 1})
+        self.assertRaises(DynamoDBConditionalCheckFailedError, event.put,
+                          expected_value={'Version': 1})
+        self.assertEquals(2, memon.table.get_item('Rolling')['Version'])
+
+    def test_sqlite_backend_queue_visibility(self):
+        memon = self.initSqliteBackend()
+        memon.send('Test')
+        q = memon.get_queue()
+        self.assertEquals(1, len(q.get_messages(10)))
+        # received but not deleted, so hidden until the visibility timeout
+        self.assertEquals([], q.get_messages(10))
+        self.assertEquals(1, q.count())
+
+    def test_sqlite_scan_segments(self):
+        from boto.dynamodb.condition import GT
+        memon = self.initSqliteBackend()
+        names = sorted(['Event%d' % (i) for i in xrange(19)] + [u'Caf\xe9'])
+        for i, name in enumerate(names):
+            attrs = dict(self.ROLLING, ErrorCount=i % 2)
+            memon.table.new_item(hash_key=name, attrs=attrs).put()
+        memon.scan_segments = 3
+        memon.scan_capacity = 1000
+        self.assertEquals(names, sorted(event['Name']
+                                        for event in memon.scan_events()))
+        errors = list(memon.scan_events({'ErrorCount': GT(0)}, ['Name']))
+        self.assertEquals(names[1::2],
+                          sorted(event['Name'] for event in errors))
+        self.assertEquals([['Name']] * 10,
+                          [event.keys() for event in errors])
+
+    @httpretty.activate
+    def test_scan_segments_dynamodb2(self):
+        from boto.dynamodb.condition import GT
+        # recorded 2012-08-10 Scan responses, the first segment has two pages
+        responses = {
+            (0, None): {'Items': [{'Name': {'S': 'A'},
+                                   'ErrorCount': {'N': '1'}}],
+                        'LastEvaluatedKey': {'Name': {'S': 'A'}},
+                        'ConsumedCapacity': {'CapacityUnits': 0.5}},
+            (0, 'A'): {'Items': [{'Name': {'S': 'B'},
+                                  'ErrorCount': {'N': '2'}}],
+                       'ConsumedCapacity': {'CapacityUnits': 0.5}},
+            (1, None): {'Items': [{'Name': {'S': 'C'},
+                                   'ErrorCount': {'N': '3'}}]}}
+        requests = []
+
+        def scan(request, uri, headers):
+            body = json.loads(request.body)
+            requests.append(body)
+            start = body.get('ExclusiveStartKey', {}).get('Name', {}).get('S')
+            return (200, headers,
+                    json.dumps(responses[(body['Segment'], start)]))
+
+        httpretty.register_uri(
+            httpretty.POST, 'https://dynamodb.us-east-1.amazonaws.com/',
+            body=scan)
+        self.memon.scan_segments = 2
+        # httpretty keeps one request per uri, so one worker scans both
+        # segments in turn rather than racing for it
+        from multiprocessing.pool import ThreadPool
+        self.memon.scan_pool = ThreadPool(1)
+        self.addCleanup(self.memon.scan_pool.close)
+        events = sorted(self.memon.scan_events({'ErrorCount': GT(0)},
+                                               ['Name', 'ErrorCount']),
+                        key=lambda event: event['Name'])
+        self.assertEquals([('A', 1), ('B', 2), ('C', 3)],
+                          [(event['Name'], event['ErrorCount'])
+                           for event in events])
+        self.assertEquals(3, len(requests))
+        for body in requests:
+            self.assertEquals(self.TABLE_NAME, body['TableName'])
+            self.assertEquals(2, body['TotalSegments'])
+            self.assertEquals(['Name', 'ErrorCount'],
+                              body['AttributesToGet'])
+            self.assertEquals({'ErrorCount': {
+                'AttributeValueList': [{'N': '0'}],
+                'ComparisonOperator': 'GT'}}, body['ScanFilter'])
+        self.assertEquals([{'Name': {'S': 'A'}}],
+                          [body['ExclusiveStartKey'] for body in requests
+                           if 'ExclusiveStartKey' in body])
+
+    def test_history(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        history = History(path, retention=1)
+        day = 86400 * 10
+        history.add(day - 10, u'Rolling', History.Heartbeat, day - 20)
+        history.add(day + 5, u'Rolling', Notification.Down)
+        history.add(day + 1, u'Fixed', History.Heartbeat, day)
+        self.assertEquals(3, history.write())
+        self.assertEquals(0, history.write())
+        self.assertEquals(2, len([filename for filename in os.listdir(path)
+                                  if filename.endswith('.hist')]))
+
+        self.assertEquals(
+            [(day - 10, 'Rolling', History.Heartbeat, day - 20),
+             (day + 1, 'Fixed', History.Heartbeat, day),
+             (day + 5, 'Rolling', Notification.Down, day + 5)],
+            list(History(path).read(0, day * 2)))
+        self.assertEquals([(day + 5, 'Rolling', Notification.Down, day + 5)],
+                          list(history.read(day, day * 2, 'Rolling')))
+        self.assertEquals([], list(history.read(day + 2, day + 5)))
+
+        history.expire(day + 86400)
+        self.assertEquals(['Fixed', 'Rolling'],
+                          [name for recorded, name, kind, event_time
+                           in history.read(0, day * 2)])
+        history.expire(day + 86400 * 2)
+        self.assertEquals([], list(history.read(0, day * 2)))
+
+    def test_history_pollers(self):
+        # a poller's batch can land after a later one from another poller
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        first, second = History(path), History(path)
+        day = 86400 * 10
+        first.add(day + 100, u'A', History.Heartbeat)
+        first.add(day + 300, u'A', History.Heartbeat)
+        first.write()
+        second.add(day + 200, u'B', History.Heartbeat)
+        second.write()
+
+        self.assertEquals([day + 100, day + 200, day + 300],
+                          [recorded for recorded, name, kind, event_time
+                           in first.read(day, day * 2)])
+        self.assertEquals([(day + 300, 'A', History.Heartbeat, day + 300)],
+                          list(second.read(day + 250, day * 2)))
+        self.assertEquals([], list(first.read(day + 150, day + 200, 'A')))
+
+    def test_history_report(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        history = History(path)
+        hour = 3600
+        day = 86400 * 10
+        for i in xrange(4):
+            history.add(day + i * hour, u'Hourly', History.Heartbeat)
+        history.add(day + 4 * hour, u'Hourly', Notification.Down)
+        history.add(day + 5 * hour, u'Hourly', Notification.Down)
+        history.write()
+        # up again half way through the next hour, 3.5 hours after going down
+        history.add(day + 7 * hour + 1800, u'Hourly', Notification.Up)
+        history.add(day + 7 * hour + 1800, u'Hourly', History.Heartbeat)
+        history.add(day + 8 * hour, u'Down', Notification.Down)
+        history.add(day + 9 * hour, u'Down', Notification.Down)
+        # a heartbeat without an Up still ends the first failure
+        history.add(day + hour, u'Flapping', Notification.Down)
+        history.add(day + 2 * hour, u'Flapping', History.Heartbeat)
+        history.add(day + 3 * hour, u'Flapping', Notification.Down)
+        history.write()
+
+        rows = history.get_rollups().report(day, day + 10 * hour)
+        self.assertEquals(['Down', 'Flapping', 'Hourly'],
+                          [row['name'] for row in rows])
+        down, flapping, hourly = rows
+        self.assertEquals(0, down['runs'])
+        self.assertEquals(1, down['failures'])
+        self.assertEquals(day + 8 * hour, down['last_failure'])
+        self.assertEquals(0.8, down['availability'])
+        self.assertEquals(2, flapping['failures'])
+        self.assertEquals(day + 3 * hour, flapping['last_failure'])
+        self.assertAlmostEquals(0.2, flapping['availability'])
+        self.assertEquals(5, hourly['runs'])
+        self.assertEquals(1, hourly['failures'])
+        self.assertEquals(day + 4 * hour, hourly['last_failure'])
+        self.assertEquals(4 * hour + 1800, hourly['longest_gap'])
+        self.assertEquals(0.65, hourly['availability'])
+
+        # the same from the daily counters
+        rows = history.get_rollups().report(day - 86400, day + 10 * hour)
+        self.assertEquals(5, rows[2]['runs'])
+        self.assertAlmostEquals(1 - 3.5 / 34, rows[2]['availability'])
+        self.assertEquals([], history.get_rollups().report(
+            day, day + 10 * hour, 'Missing'))
+
+    def test_poll_history(self):
+        memon = self.initSqliteBackend()
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        memon.history = History(path)
+        memon.save_batch([
+            memon.table.new_item(hash_key='Rolling', attrs=self.ROLLING),
+            memon.table.new_item(hash_key='Down', attrs=self.DOWN)])
+
+        memon.now = 8
+        memon.send('Rolling')
+        memon.now = 9
+        memon.poll_cycle(1)
+        self.assertEquals([(9, 'Rolling', History.Heartbeat, 8),
+                           (9, 'Down', Notification.Down, 9)],
+                          list(memon.history.read(0, 100)))
+
+    def test_bench_sqlite(self):
+        import bench_memon
+
+        class Args(object):
+            events = 20
+            heartbeats = 5
+            down = 0.1
+            period = 3600
+            cycles = 2
+            backend = 'sqlite'
+            due_table = False
+            due_buckets = 1
+            cache = False
+            resource_cache = False
+            digest = False
+            batch_writes = False
+            seed = 1
+            output = None
+
+        results = bench_memon.run(Args())
+        self.assertEquals(2, len(results['cycles']))
+        self.assertEquals(5, results['cycles'][0]['heartbeats'])
+        self.assertEquals(0, results['cycles'][1]['capacity']['write'])
+
+    @mock_sqs
+    @mock_sns
+    def test_poll_metrics(self):
+        self.initSns()
+        self.initSqs()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.table.new_item(hash_key='Down', attrs=self.DOWN).put()
+        self.sendAt('Rolling', 6)
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.memon.metrics_path = path
+        self.memon.metrics_format = 'json'
+
+        self.memon.now = 8
+        # received a second after the cycle started
+        self.fakeClock(9)
+        self.memon.poll_cycle(1)
+        self.memon.poll_cycle(1)
+
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEquals(2, len(lines))
+        metrics = lines[0]
+        self.assertEquals(1, metrics['memon_messages_received'])
+        self.assertEquals(1, metrics['memon_messages_deleted'])
+        self.assertEquals(1, metrics['memon_events_recorded'])
+        self.assertEquals(1, metrics['memon_down_events'])
+        self.assertEquals(1, metrics['memon_notifications{type="Down"}'])
+        self.assertEquals(0, metrics['memon_cycle_failed'])
+        lag = metrics['memon_heartbeat_lag_seconds']
+        self.assertEquals(1, lag['count'])
+        self.assertEquals(3, lag['sum'])
+        self.assertIn('memon_cycle_seconds{phase="poll"}', metrics)
+        requests = metrics['memon_aws_request_seconds{'
+                           'action="ReceiveMessage",service="sqs"}']
+        self.assertEquals(1, requests['count'])
+        self.assertEquals(0, lines[1]['memon_messages_received'])
+
+    def test_metrics_prometheus(self):
+        metrics = Metrics()
+        metrics.inc('memon_notifications', type='Down')
+        metrics.inc('memon_notifications', type='Down')
+        metrics.observe('memon_aws_request_seconds', 0.02,
+                        service='sqs', action='ReceiveMessage')
+        text = metrics.prometheus()
+        self.assertIn('# TYPE memon_notifications gauge\n'
+                      'memon_notifications{type="Down"} 2\n', text)
+        self.assertIn('memon_aws_request_seconds_bucket{'
+                      'action="ReceiveMessage",service="sqs",le="0.01"} 0\n',
+                      text)
+        self.assertIn('memon_aws_request_seconds_bucket{'
+                      'action="ReceiveMessage",service="sqs",le="0.025"} 1\n',
+                      text)
+        self.assertIn('memon_aws_request_seconds_count{'
+                      'action="ReceiveMessage",service="sqs"} 1\n', text)
+
+    def test_shard_leases(self):
+        first = self.memon
+        second = MEMon()
+        for memon, poller_id in [(first, 'first'), (second, 'second')]:
+            memon.shards = 4
+            memon.poller_id = poller_id
+            memon.now = 100
+            self.initLeaseTable(memon)
+
+        self.assertEquals([0, 1, 2, 3], first.claim_shards())
+        self.assertEquals([], second.claim_shards())
+        # the first poller hands over the shards beyond its share
+        first.now = second.now = 110
+        self.assertEquals([0, 1], first.claim_shards())
+        self.assertEquals([2, 3], second.claim_shards())
+        self.assertEquals([0, 1], first.claim_shards())
+
+        # failover once the first poller's leases expire
+        second.now = 110 + first.lease_ttl
+        self.assertEquals([0, 1, 2, 3], second.claim_shards())
+
+        second.owned_shards = [0, 1, 2, 3]
+        second.release_shards()
+        self.assertEquals([0, 1, 2, 3], first.claim_shards())
+
+    @mock_sns
+    def test_shard_notify_down_events(self):
+        self.initSns()
+        self.memon.shards = 2
+        names = ['Down%d' % (i) for i in xrange(10)]
+        mine = [name for name in names if self.memon.shard(name) == 0]
+        theirs = [name for name in names if self.memon.shard(name) == 1]
+        for name in mine[:1] + theirs[:1]:
+            self.table.new_item(hash_key=name, attrs=self.DOWN).put()
+        self.memon.owned_shards = [0]
+        self.memon.now = 100
+        self.memon.notify_down_events()
+
+        event = self.table.get_item(hash_key=mine[0])
+        self.assertEquals(1, event['ErrorCount'])
+        event = self.table.get_item(hash_key=theirs[0])
+        self.assertEquals(0, event['ErrorCount'])
+
+    def test_shard_unicode_name(self):
+        self.memon.shards = 4
+        self.memon.due_buckets = 4
+        name = u'Caf\xe9'
+        self.assertEquals(self.memon.due_bucket(name), self.memon.shard(name))
+        self.assertEquals(self.memon.shard(name.encode('utf-8')),
+                          self.memon.shard(name))
+
+    @mock_sns
+    def test_shard_record_conflict(self):
+        self.initSns()
+        self.memon.shards = 2
+        self.memon.server_time = False
+        event = self.table.new_item(hash_key='Rolling', attrs=self.ROLLING)
+        event['Version'] = 1
+        event.put()
+
+        # another poller saves the event between our read and write
+        get_item = self.table.get_item
+
+        def stale_get_item(*args, **kwargs):
+            item = get_item(*args, **kwargs)
+            if not kwargs.get('consistent_read'):
+                other = get_item('Rolling')
+                other['Version'] = 2
+                other.put()
+            return item
+        self.table.get_item = stale_get_item
+
+        self.memon.record('Rolling', 8)
+        event = get_item('Rolling')
+        self.assertEquals(8, event['LastSuccessTime'])
+        self.assertEquals(3, event['Version'])
+
+    def captureUpdates(self):
+        updates = []
+        update_item = self.db.layer1.update_item
+
+        def capture(table_name, key, attribute_updates, *args, **kwargs):
+            updates.append(attribute_updates)
+            return update_item(table_name, key, attribute_updates,
+                               *args, **kwargs)
+        self.db.layer1.update_item = capture
+        return updates
+
+    @mock_sns
+    def test_record_partial_update(self):
+        self.initSns()
+        attrs = dict(self.ROLLING, Description='x' * 1000)
+        self.table.new_item(hash_key='Rolling', attrs=attrs).put()
+        updates = self.captureUpdates()
+
+        self.memon.record('Rolling', 8)
+
+        self.assertEquals(1, len(updates))
+        self.assertEquals(['ErrorCount', 'LastBlockTime', 'LastSuccessTime',
+                           'NextBlockTime', 'NotifyTime', 'Version'],
+                          sorted(updates[0]))
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(8, event['LastSuccessTime'])
+        self.assertEquals('x' * 1000, event['Description'])
+
+    @mock_sns
+    def test_record_batch_partial_update(self):
+        self.initSns()
+        attrs = dict(self.ROLLING, Description='x' * 1000)
+        self.table.new_item(hash_key='Rolling', attrs=attrs).put()
+        self.table.new_item(hash_key='Fixed', attrs=self.FIXED).put()
+        updates = self.captureUpdates()
+
+        def batch_write_item(*args, **kwargs):
+            raise Exception('heartbeats should not rewrite whole events')
+        self.db.layer1.batch_write_item = batch_write_item
+
+        self.memon.record_batch({'Rolling': 8, 'Fixed': 12})
+
+        self.assertEquals(2, len(updates))
+        for update in updates:
+            self.assertEquals(['ErrorCount', 'LastBlockTime',
+                               'LastSuccessTime', 'NextBlockTime',
+                               'NotifyTime', 'Version'], sorted(update))
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(8, event['LastSuccessTime'])
+        self.assertEquals('x' * 1000, event['Description'])
+        self.getPostMessage().should.contain('Late: Fixed')
+
+    @mock_sns
+    def test_down_notify_partial_update(self):
+        self.initSns()
+        attrs = dict(self.DOWN, Description='x' * 1000)
+        self.table.new_item(hash_key='Down', attrs=attrs).put()
+        updates = self.captureUpdates()
+
+        self.memon.now = 100
+        self.memon.notify_down_events()
+
+        self.assertEquals(['ErrorCount', 'NotifyTime', 'Version'],
+                          sorted(updates[0]))
+        self.assertEquals('ADD', updates[0]['ErrorCount']['Action'])
+        event = self.table.get_item(hash_key='Down')
+        self.assertEquals(1, event['ErrorCount'])
+        self.getPostMessage().should.contain('Down: Down')
+
+    @mock_sns
+    def test_down_notify_after_heartbeat(self):
+        self.initSns()
+        self.table.new_item(hash_key='Down', attrs=self.DOWN).put()
+
+        # a heartbeat is recorded between the scan and the write
+        scan = self.table.scan
+
+        def stale_scan(*args, **kwargs):
+            items = list(scan(*args, **kwargs))
+            self.memon.record('Down', 99)
+            return items
+        self.table.scan = stale_scan
+        self.memon.now = 100
+        self.memon.notify_down_events()
+
+        event = self.table.get_item(hash_key='Down')
+        self.assertEquals(0, event['ErrorCount'])
+        self.assertEquals(99, event['LastSuccessTime'])
+        self.getPostMessage().should_not.contain('Down: Down')
+
+    def test_spool_take_locked(self):
+        spool = self.initSpool()
+        spool.append({'name': 'Test', 'time': 1})
+        self.assertEquals([{'name': 'Test', 'time': 1}], spool.take())
+        self.assertEquals(None, Spool(spool.path).take())
+        spool.release()
+
+    @mock_sns
+    def test_record_batch(self):
+        self.initSns()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.table.new_item(hash_key='Fixed', attrs=self.FIXED).put()
+
+        def get_item(*args, **kwargs):
+            raise Exception('record_batch should not get items one by one')
+        self.table.get_item = get_item
+
+        self.memon.record_batch({'Rolling': 8, 'Fixed': 12})
+
+        del self.table.get_item
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(8, event['LastBlockTime'])
+        self.assertEquals(13, event['NextBlockTime'])
+        self.assertEquals(8, event['LastSuccessTime'])
+        event = self.table.get_item(hash_key='Fixed')
+        self.assertEquals(15, event['LastBlockTime'])
+        self.assertEquals(20, event['NextBlockTime'])
+        self.assertEquals(12, event['LastSuccessTime'])
+        self.getPostMessage().should.contain('Late: Fixed')
+
+    @mock_sns
+    def test_record_batch_second_chunk_fails(self):
+        self.initSns()
+        self.initDueTable()
+        self.memon.batch_writes = True
+        names = ['Event%02d' % (i) for i in xrange(20)]
+        for name in names:
+            self.table.new_item(hash_key=name, attrs=self.ROLLING).put()
+        calls = []
+        batch_write_item = self.db.layer1.batch_write_item
+
+        def fail_second_batch(request, *args, **kwargs):
+            calls.append(request)
+            if len(calls) == 2:
+                raise Exception('Transient failure')
+            return batch_write_item(request, *args, **kwargs)
+        self.db.layer1.batch_write_item = fail_second_batch
+        notified = []
+        self.memon.notify = (lambda name, notification, event=None:
+                             notified.append((name, notification)))
+
+        self.memon.record_batch(dict((name, 12) for name in names))
+
+        # the 20 due rows and 5 events made the first batch, the other 15
+        # events are saved one at a time from the event as it was read.
+        # Every event was late, whichever way it was saved.
+        events = [self.table.get_item(hash_key=name) for name in names]
+        self.assertEquals([12] * 20,
+                          [event['LastSuccessTime'] for event in events])
+        self.assertEquals([1] * 20, [event['Version'] for event in events])
+        self.assertEquals([(name, Notification.Late) for name in names],
+                          sorted(notified))
+        self.assertEquals(sorted(self.memon.due_key(event['Name'],
+                                                    event['NotifyTime'])
+                                 for event in events), self.getDueKeys())
+
+    @mock_sns
+    def test_record_concurrently(self):
+        self.initSns()
+        self.memon.record_workers = 3
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.table.new_item(hash_key='Fixed', attrs=self.FIXED).put()
+
+        tables = []
+        record_event = self.memon.record_event
+
+        def worker_record_event(name, event_time):
+            tables.append(self.memon.table)
+            return record_event(name, event_time)
+        self.memon.record_event = worker_record_event
+        published = []
+        self.memon.publish = (lambda subject, message, sns=None:
+                              published.append(subject))
+
+        self.memon.record_batch({'Rolling': 8, 'Fixed': 12, 'Unknown': 1})
+
+        # every worker reads and writes through its own connection
+        self.assertEquals(3, len(tables))
+        self.assertNotIn(self.table, tables)
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(8, event['LastSuccessTime'])
+        self.assertEquals(1, event['Version'])
+        event = self.table.get_item(hash_key='Fixed')
+        self.assertEquals(12, event['LastSuccessTime'])
+        self.assertEquals(
+            ['[MEMon] Config: Unknown has a configuration error',
+             '[MEMon] Late: Fixed'], sorted(published))
+
+    @mock_sns
+    def test_reload_record_workers(self):
+        self.initSns()
+        self.memon.db = self.db
+        self.memon.table_name = self.TABLE_NAME
+        self.memon.record_workers = 2
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.memon.record_batch({'Rolling': 8})
+        pool = self.memon.record_pool
+        self.assertIsNotNone(pool)
+
+        self.memon.reload()
+        self.assertIsNone(self.memon.record_pool)
+        self.memon.record_batch({'Rolling': 9})
+        self.assertIsNot(pool, self.memon.record_pool)
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(9, event['LastSuccessTime'])
+
+    @mock_sqs
+    @mock_sns
+    def test_poll_record_workers_bad_type(self):
+        import threading
+
+        self.initSns()
+        self.initSqs()
+        self.memon.record_workers = 2
+        self.table.new_item(hash_key='Bad',
+                            attrs=dict(self.ROLLING, Type='bogus')).put()
+        self.table.new_item(hash_key='Fixed', attrs=self.FIXED).put()
+        self.sendAt('Bad', 8)
+        self.sendAt('Fixed', 12)
+
+        notified = []
+        notify = self.memon.notify
+
+        def record_notify(name, notification, event=None):
+            notified.append((name, notification,
+                             threading.current_thread().name))
+            return notify(name, notification, event)
+        self.memon.notify = record_notify
+
+        self.assertEquals(2, self.memon.poll(2))
+        # only the polling thread sends notifications
+        main = threading.current_thread().name
+        self.assertEquals([('Bad', Notification.ConfigError, main),
+                           ('Fixed', Notification.Late, main)], notified)
+        event = self.table.get_item(hash_key='Bad')
+        self.assertEquals(5, event['LastSuccessTime'])
+
+    @mock_sns
+    def test_record_batch_unknown_event(self):
+        self.initSns()
+        self.memon.record_batch({'UnknownEvent': 1})
+        self.getPostMessage().should.contain('Config: UnknownEvent')
+
+    @mock_sqs
+    def test_poll_empty_queue(self):
+        self.initSqs()
+        self.assertEquals(0, self.memon.poll())
+
+    @mock_sqs
+    @mock_sns
+    def test_poll_budget(self):
+        self.initSns()
+        q = self.initSqs()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        for i in xrange(25):
+            self.sendAt('Rolling', 6 + i)
+        self.memon.poll_budget = 50
+        self.memon.wait_time = 1
+        self.memon.drain_size = 10
+        batches = []
+        record_batch = self.memon.record_batch
+
+        def count_record_batch(events):
+            batches.append(events)
+            return record_batch(events)
+        self.memon.record_batch = count_record_batch
+
+        # drains past poll_count, recording every drain_size messages
+        self.assertEquals(25, self.memon.poll(1))
+        self.assertEquals(3, len(batches))
+        self.assertEquals(0, q.count())
+        self.assertEquals(
+            0, self.memon.metrics.values[('memon_queue_backlog', ())])
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(30, event['LastSuccessTime'])
+
+        self.sendAt('Rolling', 40)
+        self.memon.poll_budget = 1e-9
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.assertEquals(0, self.memon.poll(1))
+            self.assertIn('about 1 messages left', sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+
+    def fakeClock(self, start):
+        # Stands in for memon's time module with a clock that only moves on
+        # when memon sleeps or the test moves it
+        import memon
+        clock = [start]
+
+        class Clock(object):
+            def time(self):
+                return clock[0]
+
+            def sleep(self, seconds):
+                clock[0] += seconds
+
+            def __getattr__(self, name):
+                return getattr(time, name)
+        self.addCleanup(setattr, memon, 'time', time)
+        memon.time = Clock()
+        return clock
+
+    def fakePollQueue(self, delay, messages):
+        # A queue whose receives take delay seconds of a fake clock
+        clock = self.fakeClock(1000.0)
+
+        class FakeQueue(object):
+            waits = []
+
+            def get_messages(self, count, wait_time_seconds=0):
+                self.waits.append(wait_time_seconds)
+                clock[0] += min(delay, wait_time_seconds)
+                return messages[:count]
+
+            def count(self):
+                return len(messages)
+        q = FakeQueue()
+        self.memon.get_queue = lambda: q
+        self.memon.process_messages = lambda q, received: len(received)
+        return q
+
+    def test_poll_budget_long_poll(self):
+        # messages trickle in every 3s, and no receive waits past the budget
+        q = self.fakePollQueue(3, [boto.sqs.message.Message()])
+        self.memon.wait_time = 10
+        self.memon.poll_budget = 10
+        self.assertEquals(4, self.memon.poll(1))
+        self.assertEquals([10, 7, 4, 1], q.waits)
+
+    def test_poll_budget_short_poll(self):
+        # an empty short poll isn't taken as drained, but backs off rather
+        # than receiving back to back
+        q = self.fakePollQueue(0, [])
+        self.memon.wait_time = 0
+        self.memon.poll_budget = 3
+        self.assertEquals(0, self.memon.poll(1))
+        self.assertEquals([0, 0, 0], q.waits)
+
+    def test_poll_lock(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.memon.lock_path = path
+        other = MEMon()
+        other.lock_path = path
+        with self.memon.poll_lock() as locked:
+            self.assertTrue(locked)
+            with other.poll_lock() as other_locked:
+                self.assertFalse(other_locked)
+        with other.poll_lock() as other_locked:
+            self.assertTrue(other_locked)
+
+    @mock_sns
+    def test_due_index_notify(self):
+        self.initSns()
+        self.initDueTable()
+        date = datetime.date(2010, 1, 1)
+        self.memon.config('Fixed', 5, True, PeriodType.Fixed,
+                          'desc', date, None)
+        due = int(date.strftime('%s'))
+        self.assertEquals(['%010d:Fixed' % (due)], self.getDueKeys())
+
+        def scan(*args, **kwargs):
+            raise Exception('notify_down_events should not scan')
+        self.table.scan = scan
+
+        self.memon.notify_down_events()
+
+        event = self.table.get_item(hash_key='Fixed')
+        self.assertEquals(1, event['ErrorCount'])
+        self.assertEquals(due + 5, event['NotifyTime'])
+        self.assertEquals(['%010d:Fixed' % (due + 5)], self.getDueKeys())
+        self.getPostMessage().should.contain('Down: Fixed')
+
+    @mock_sns
+    def test_due_index_write_fails(self):
+        from boto.dynamodb.exceptions import DynamoDBThroughputExceededError
+        self.initSns()
+        self.initDueTable()
+        self.table.new_item(hash_key='Down', attrs=self.DOWN).put()
+        self.memon.reindex()
+        self.memon.now = 100
+        batch_write_item = self.db.layer1.batch_write_item
+        failing = []
+
+        def fail_requests(request, *args, **kwargs):
+            for requests in request.values():
+                if any(failing[0] in row for row in requests):
+                    raise DynamoDBThroughputExceededError(
+                        400, 'ProvisionedThroughputExceededException')
+            return batch_write_item(request, *args, **kwargs)
+        self.db.layer1.batch_write_item = fail_requests
+        notified = []
+        self.memon.notify = (lambda name, notification, event=None:
+                             notified.append(notification))
+
+        # the new row can't be written, so neither is the event
+        failing.append('PutRequest')
+        self.memon.notify_down_events()
+        self.assertEquals([], notified)
+        event = self.table.get_item(hash_key='Down')
+        self.assertEquals(0, event['ErrorCount'])
+        self.assertEquals(['%010d:Down' % (6)], self.getDueKeys())
+
+        # the event is saved once the new row is, and the old row left
+        # behind is dropped when it comes due
+        failing[0] = 'DeleteRequest'
+        self.memon.notify_down_events()
+        self.assertEquals([Notification.Down], notified)
+        event = self.table.get_item(hash_key='Down')
+        self.assertEquals(1, event['ErrorCount'])
+        self.assertEquals(['%010d:Down' % (6), '%010d:Down' % (11)],
+                          self.getDueKeys())
+        failing[0] = 'None'
+        self.memon.notify_down_events()
+        self.assertEquals([Notification.Down] * 2, notified)
+        self.assertEquals(['%010d:Down' % (16)], self.getDueKeys())
+
+    @mock_sns
+    def test_due_index_record(self):
+        self.initSns()
+        self.initDueTable()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.memon.reindex()
+        self.assertEquals(['%010d:Rolling' % (10)], self.getDueKeys())
+
+        self.memon.record_batch({'Rolling': 8})
+        self.assertEquals(['%010d:Rolling' % (13)], self.getDueKeys())
+
+        self.memon.config('Rolling', 5, False)
+        self.assertEquals([], self.getDueKeys())
+
+    def test_due_index_unicode_name(self):
+        # ddbmock can't store non-ascii names, so just index the event
+        self.initDueTable()
+        self.memon.due_buckets = 4
+        name = u'Caf\xe9'
+        event = self.table.new_item(hash_key=name, attrs=self.ROLLING)
+        puts, deletes = self.memon.index_event(event)
+        self.assertEquals([self.memon.due_key(name, 10)],
+                          [row['Due'] for row in puts])
+        self.assertEquals(self.memon.due_bucket(name.encode('utf-8')),
+                          puts[0]['Bucket'])
+
+    @mock_sns
+    def test_due_index_stale_row(self):
+        self.initSns()
+        self.initDueTable()
+        self.memon.due_table.new_item(hash_key=0,
+                                      range_key='%010d:Gone' % (1),
+                                      attrs={'Name': 'Gone'}).put()
+
+        self.memon.notify_down_events()
+
+        self.assertEquals([], self.getDueKeys())
+        # empty body request - presumably from the sns subscription
+        self.assertEqual(0, len(httpretty.last_request().body))
+
+    def initCache(self):
+        self.memon.cache = EventCache(':memory:')
+        self.memon.refresh_cache(True)
+
+    def disableReads(self):
+        def read(*args, **kwargs):
+            raise Exception('should be read from the cache')
+        self.table.get_item = read
+        self.table.batch_get_item = read
+        self.table.scan = read
+
+    def enableReads(self):
+        del self.table.get_item
+        del self.table.batch_get_item
+        del self.table.scan
+
+    @mock_sns
+    def test_cache_record(self):
+        self.initSns()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.initCache()
+        self.disableReads()
+
+        self.memon.record_batch({'Rolling': 12})
+
+        self.enableReads()
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(12, event['LastSuccessTime'])
+        self.assertEquals(17, event['NextBlockTime'])
+        self.assertEquals(1, event['Version'])
+        self.assertEquals(1, self.memon.cache.get('Rolling')['Version'])
+        self.getPostMessage().should.contain('Late: Rolling')
+
+    @mock_sns
+    def test_cache_stale_record(self):
+        self.initSns()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.initCache()
+
+        # change the period behind the cache's back
+        other = MEMon()
+        other.table = self.table
+        other.config('Rolling', 10, True)
+
+        self.memon.record('Rolling', 8)
+
+        event = self.table.get_item(hash_key='Rolling')
+        self.assertEquals(10, event['Period'])
+        self.assertEquals(18, event['NextBlockTime'])
+        self.assertEquals(2, event['Version'])
+        self.assertEquals(2, self.memon.cache.get('Rolling')['Version'])
+
+    @mock_sns
+    def test_cache_refresh(self):
+        self.initSns()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.table.new_item(hash_key='Fixed', attrs=self.FIXED).put()
+        self.initCache()
+        self.assertEquals(0, self.memon.refresh_cache(True))
+
+        other = MEMon()
+        other.table = self.table
+        other.config('Fixed', 20, True)
+        self.table.get_item(hash_key='Rolling').delete()
+
+        self.assertEquals(0, self.memon.refresh_cache())
+        self.assertEquals(1, self.memon.refresh_cache(True))
+        self.assertEquals(20, self.memon.cache.get('Fixed')['Period'])
+        self.assertEquals(None, self.memon.cache.get('Rolling'))
+
+    @mock_sns
+    def test_cache_down_notify(self):
+        self.initSns()
+        self.table.new_item(hash_key='Down', attrs=self.DOWN).put()
+        self.initCache()
+        self.disableReads()
+
+        self.memon.notify_down_events()
+
+        self.enableReads()
+        event = self.table.get_item(hash_key='Down')
+        self.assertEquals(1, event['ErrorCount'])
+        self.getPostMessage().should.contain('Down: Down')
+
+    def initResourceCache(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.memon.resources = ResourceCache(path, 3600)
+        return path
+
+    def test_resource_cache_unwritable(self):
+        # a cache that can't be saved is only looked up again
+        handle, parent = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, parent)
+        cache = ResourceCache(os.path.join(parent, 'resources.json'), 3600)
+        cache.set('queue', 'url')
+        self.assertEquals('url', cache.get('queue'))
+        self.assertTrue(cache.invalidate('queue'))
+
+    def test_resource_cache_threads(self):
+        import threading
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        cache = ResourceCache(os.path.join(path, 'resources.json'), 3600)
+        threads = [threading.Thread(target=lambda i=i: [
+            cache.set('key%d' % (i), j) for j in xrange(20)])
+            for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # no temp files are left behind or renamed over by another thread
+        self.assertEquals(['resources.json'], os.listdir(path))
+        cache.set('done', 1)
+        saved = ResourceCache(cache.path, 3600)
+        self.assertEquals([19] * 4,
+                          [saved.get('key%d' % (i)) for i in xrange(4)])
+
+    @mock_sns
+    def test_resource_cache_topic_arn(self):
+        self.initSns()
+        path = self.initResourceCache()
+        arn = self.memon.get_topic_arn()
+
+        def get_all_topics(*args, **kwargs):
+            raise Exception('topic arn should be cached')
+        self.memon.sns_conn.get_all_topics = get_all_topics
+
+        # a fresh cache instance reads the arn back from disk
+        self.memon.resources = ResourceCache(path, 3600)
+        self.assertEquals(arn, self.memon.get_topic_arn())
+
+        self.memon.resources = ResourceCache(path, 0)
+        self.assertRaises(Exception, self.memon.get_topic_arn)
+
+    @mock_sqs
+    def test_resource_cache_queue_url(self):
+        q = self.initSqs()
+        self.initResourceCache()
+        self.memon.send('Test')
+
+        def get_queue(*args, **kwargs):
+            raise Exception('queue url should be cached')
+        self.memon.sqs.get_queue = get_queue
+
+        self.memon.send('Test')
+        self.assertEquals(2, q.count())
+
+    def test_send_startup(self):
+        # send should only load and connect to sqs, here with the queue url
+        # already cached so the message is its only request
+        path = self.initResourceCache()
+        url = 'https://queue.amazonaws.com/123456789012/memon'
+        self.memon.resources.set(
+            self.memon.resource_key('queue', 'memon'), url)
+        script = ('import sys\n'
+                  'import memon\n'
+                  'sent = []\n'
+                  'memon.Queue.write = lambda q, m: sent.append(q.url)\n'
+                  'm = memon.MEMon()\n'
+                  'm.main(sys.argv[1:])\n'
+                  'print " ".join(sent)\n'
+                  'print m._sns_conn, m._db\n'
+                  'print " ".join(sys.modules)\n')
+        output = subprocess.check_output(
+            [sys.executable, '-c', script, '--region', 'us-east-1',
+             '--queue', 'memon', '--resource-cache', path, 'send', 'Test'],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        sent, conns, modules = output.splitlines()
+        self.assertEquals(url, sent)
+        self.assertEquals('None None', conns)
+        for module in modules.split():
+            self.assertFalse(module.startswith('boto.dynamodb'), module)
+            self.assertFalse(module.startswith('boto.sns'), module)
+            self.assertFalse(module.startswith('multiprocessing'), module)
+        for module in ('sqlite3', 'mmap'):
+            self.assertNotIn(module, modules.split())
+
+    @mock_sns
+    def test_resource_cache_stale_topic_arn(self):
+        self.initSns()
+        self.initResourceCache()
+        self.memon.resources.set(
+            self.memon.resource_key('topic', self.memon.sns),
+            'arn:aws:sns:us-east-1:123456789012:gone')
+
+        self.memon.notify('Test', Notification.Down)
+
+        self.getPostMessage().should.contain('Down: Test')
+        self.assertEquals(self.memon.get_topic_arn(),
+                          self.memon.resources.get(self.memon.resource_key(
+                              'topic', self.memon.sns)))
+
+    def epoch(self, *args):
+        return int(time.mktime(datetime.datetime(*args).timetuple()))
+
+    def test_fixed_schedule_long_outage(self):
+        schedule = FixedSchedule(5)
+        self.assertEquals((10, 15), schedule.advance(5, 8))
+        self.assertEquals((10, 15), schedule.advance(5, 10))
+        self.assertEquals((15, 20), schedule.advance(5, 12))
+        self.assertEquals((10, 15), schedule.advance(5, 1))
+        self.assertEquals((5000005, 5000010), schedule.advance(5, 5000003))
+
+    def test_cron_schedule(self):
+        schedule = CronSchedule('0 2 * * mon-fri')
+        # friday night to monday morning
+        self.assertEquals(self.epoch(2015, 1, 5, 2, 0),
+                          schedule.next_fire(self.epoch(2015, 1, 2, 3, 0)))
+        self.assertEquals(self.epoch(2015, 1, 2, 2, 0),
+                          schedule.next_fire(self.epoch(2015, 1, 2, 2, 0)))
+
+        schedule = CronSchedule('*/15 9-17 1,15 * *')
+        self.assertEquals(self.epoch(2015, 1, 15, 9, 0),
+                          schedule.next_fire(self.epoch(2015, 1, 1, 17, 46)))
+        self.assertEquals(self.epoch(2015, 1, 1, 17, 45),
+                          schedule.next_fire(self.epoch(2015, 1, 1, 17, 31)))
+
+        schedule = CronSchedule('0 0 29 2 *')
+        self.assertEquals(self.epoch(2016, 2, 29, 0, 0),
+                          schedule.next_fire(self.epoch(2015, 1, 1, 0, 0)))
+
+        self.assertRaises(ValueError, CronSchedule, '0 2 * *')
+        self.assertRaises(ValueError, CronSchedule, '0 25 * * *')
+        self.assertRaises(ValueError, CronSchedule, '0 2 * * mon/0')
+
+    @mock_sns
+    def test_record_cron_event(self):
+        self.initSns()
+        self.memon.config('Cron', 3600, True, 'cron', None, None, None,
+                          '0 2 * * 1-5')
+        self.memon.record('Cron', self.epoch(2015, 1, 2, 1, 30))
+
+        event = self.table.get_item(hash_key='Cron')
+        self.assertEquals(self.epoch(2015, 1, 2, 2, 0), event['LastBlockTime'])
+        self.assertEquals(self.epoch(2015, 1, 5, 2, 0), event['NextBlockTime'])
+
+    def test_config_cron_requires_schedule(self):
+        self.assertRaises(Exception, self.memon.config,
+                          'Cron', 3600, True, 'cron')
+        self.assertRaises(ValueError, self.memon.config,
+                          'Cron', 3600, True, 'cron', None, None, None,
+                          'not a schedule')
+
+    def writeConfig(self, configs):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as f:
+            json.dump(configs, f)
+        return path
+
+    def test_config_import(self):
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.table.new_item(hash_key='Fixed', attrs=self.FIXED).put()
+        self.table.new_item(hash_key='Down', attrs=self.DOWN).put()
+        path = self.writeConfig([
+            {'Name': 'Rolling', 'Period': 5, 'Type': 'rolling'},
+            {'Name': 'Fixed', 'Period': 60, 'Type': 'fixed',
+             'Description': 'desc'},
+            {'Name': 'Cron', 'Period': 3600, 'Type': 'cron',
+             'Schedule': '0 2 * * *', 'Enabled': False},
+        ])
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.memon.config_import(path)
+            summary = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEquals('Created 1, updated 1, deleted 0 and left 1 events '
+                          'unchanged\n', summary)
+
+        event = self.table.get_item(hash_key='Fixed')
+        self.assertEquals(60, event['Period'])
+        self.assertEquals('desc', event['Description'])
+        self.assertEquals(5, event['LastSuccessTime'])
+        event = self.table.get_item(hash_key='Cron')
+        self.assertEquals(0, event['Enabled'])
+        self.assertEquals(0, event['ErrorCount'])
+        self.assertIn('NextBlockTime', event)
+        self.assertNotIn('Version', self.table.get_item(hash_key='Rolling'))
+
+        # exported config imports with no writes, pruning Down
+        export = self.writeConfig([])
+        self.memon.config_export(export)
+        with open(export) as f:
+            configs = json.load(f)
+        self.assertEquals(['Cron', 'Down', 'Fixed', 'Rolling'],
+                          [config['Name'] for config in configs])
+        path = self.writeConfig([config for config in configs
+                                 if config['Name'] != 'Down'])
+        writes = []
+        batch_write_item = self.db.layer1.batch_write_item
+
+        def count_batch_write_item(request, *args, **kwargs):
+            writes.append(request)
+            return batch_write_item(request, *args, **kwargs)
+        self.db.layer1.batch_write_item = count_batch_write_item
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.memon.config_import(path, prune=True)
+            summary = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEquals('Created 0, updated 0, deleted 1 and left 3 events '
+                          'unchanged\n', summary)
+        self.assertEquals(1, len(writes))
+        self.assertEquals(['Cron', 'Fixed', 'Rolling'],
+                          sorted(event['Name'] for event in self.table.scan()))
+
+    def test_config_import_invalid(self):
+        path = self.writeConfig([{'Name': 'Rolling', 'Period': 5,
+                                  'Type': 'rolling', 'Period ': 6}])
+        self.assertRaises(Exception, self.memon.config_import, path)
+        path = self.writeConfig([{'Name': 'Cron', 'Period': 5,
+                                  'Type': 'cron'}])
+        self.assertRaises(Exception, self.memon.config_import, path)
+        self.assertEquals([], list(self.table.scan()))
+
+    def initOutbox(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.memon.outbox = Outbox(path)
+
+    @mock_sns
+    def test_outbox_notify(self):
+        self.initSns()
+        self.initOutbox()
+        self.memon.notify('First', Notification.Down)
+        self.memon.notify('Second', Notification.Up)
+
+        # nothing is published until the outbox is drained
+        self.assertEqual(0, len(httpretty.last_request().body))
+        self.assertEquals(2, self.memon.outbox.depth()[0])
+
+        self.assertEquals(2, self.memon.drain_outbox())
+        self.assertEquals(0, self.memon.outbox.depth()[0])
+        self.assertEquals(2, self.memon.outbox_stats['delivered'])
+        self.assertEquals(0, self.memon.drain_outbox())
+
+    @mock_sns
+    def test_outbox_retry(self):
+        self.initSns()
+        self.initOutbox()
+        self.memon.sns = 'missing'
+        self.memon.notify('Test', Notification.Down)
+
+        self.assertEquals(1, self.memon.drain_outbox())
+        self.assertEquals(1, self.memon.outbox_stats['failed'])
+        self.assertEquals(1, self.memon.outbox.depth()[0])
+        # backed off, so not retried straight away
+        self.assertEquals(0, self.memon.drain_outbox())
+
+    @mock_sns
+    def test_outbox_drainer(self):
+        self.initSns()
+        self.initOutbox()
+        drainer = OutboxDrainer(self.memon, 0.01)
+        drainer.start()
+        self.memon.notify('Test', Notification.Down)
+        drainer.stop(10)
+
+        self.assertFalse(drainer.is_alive())
+        self.assertEquals(0, self.memon.outbox.depth()[0])
+        self.getPostMessage().should.contain('Down: Test')
+
+    @mock_sns
+    def test_digest(self):
+        self.initSns()
+        self.memon.digest = True
+        self.memon.notify('First', Notification.Down, self.TEST)
+        self.memon.notify('Second', Notification.Down)
+        self.memon.notify('Third', Notification.Late)
+
+        # empty body request - presumably from the sns subscription
+        self.assertEqual(0, len(httpretty.last_request().body))
+
+        subjects = []
+        publish = self.memon.publish
+        self.memon.publish = (
+            lambda subject, message, sns=None: (subjects.append(subject) or
+                                                publish(subject, message,
+                                                        sns)))
+
+        self.assertEquals(1, self.memon.flush_alerts())
+        message = self.getPostMessage()
+        message.should.contain('Down: First')
+        message.should.contain('First: desc')
+        message.should.contain('Down: Second')
+        message.should.contain('Late: Third')
+        self.assertEquals(['[MEMon] 3 alerts: 2 Down, 1 Late'], subjects)
+
+        self.assertEquals(0, self.memon.flush_alerts())
+
+    @mock_sns
+    def test_digest_single_alert(self):
+        self.initSns()
+        self.memon.digest = True
+        self.memon.notify('Test', Notification.Down, self.TEST)
+        self.memon.flush_alerts()
+        digest = self.getPostMessage()
+
+        self.memon.digest = False
+        self.memon.notify('Test', Notification.Down, self.TEST)
+        self.assertEquals(digest, self.getPostMessage())
+
+    @mock_sns
+    def test_digest_rate_limit(self):
+        self.initSns()
+        self.memon.digest = True
+        self.memon.notify_bucket = TokenBucket(0.001, 1)
+
+        self.memon.notify('First', Notification.Down)
+        self.assertEquals(1, self.memon.flush_alerts())
+        self.memon.notify('Second', Notification.Down)
+        self.assertEquals(0, self.memon.flush_alerts())
+        self.getPostMessage().should.contain('Down: First')
+
+        # deferred alerts go out with the next digest
+        self.memon.notify_bucket.tokens = 1
+        self.memon.notify('Third', Notification.Down)
+        self.assertEquals(1, self.memon.flush_alerts())
+        self.getPostMessage().should.contain('Down: Second')
+        self.getPostMessage().should.contain('Down: Third')
+
+    def test_capacity_limiter(self):
+        metrics = Metrics()
+        limiter = CapacityLimiter(metrics, burst=1)
+        limiter.provision('memon', 100, 100)
+        limiter.provision('ondemand', 0, 0)
+
+        class Conn(object):
+            throughput_exceeded_events = 0
+            responses = [
+                {'ConsumedCapacityUnits': 60},
+                {'Responses': {'memon': {'ConsumedCapacityUnits': 41},
+                               'ondemand': {'ConsumedCapacityUnits': 5}}},
+                {'ConsumedCapacity': {'TableName': 'memon',
+                                      'CapacityUnits': 99}},
+            ]
+
+            def make_request(self, action, body='', object_hook=None):
+                return self.responses.pop(0)
+        conn = limiter.install(Conn())
+        conn.make_request('GetItem', json.dumps({'TableName': 'memon'}))
+        self.assertEquals({}, limiter.waited)
+        conn.make_request('BatchWriteItem', '{}')
+        self.assertEquals({}, limiter.waited)
+        conn.make_request(action='Scan', body='{}')
+        self.assertEquals([('memon', 'read')], limiter.waited.keys())
+        self.assertTrue(0.5 < limiter.waited[('memon', 'read')] < 0.6)
+        self.assertEquals(
+            {('memon_consumed_capacity',
+              (('kind', 'read'), ('table', 'memon'))): 159,
+             ('memon_consumed_capacity',
+              (('kind', 'write'), ('table', 'memon'))): 41,
+             ('memon_consumed_capacity',
+              (('kind', 'write'), ('table', 'ondemand'))): 5},
+            metrics.values)
+
+    @mock_sqs
+    @mock_sns
+    def test_record_throttled(self):
+        from boto.dynamodb.exceptions import DynamoDBThroughputExceededError
+        self.initSns()
+        self.initSqs()
+        self.table.new_item(hash_key='Rolling', attrs=self.ROLLING).put()
+        self.sendAt('Rolling', 8)
+
+        def throttled(*args, **kwargs):
+            raise DynamoDBThroughputExceededError(
+                400, 'ProvisionedThroughputExceededException')
+        self.table.batch_get_item = throttled
+        self.table.get_item = throttled
+        notifications = []
+        self.memon.notify = lambda name, notification, event=None: \
+            notifications.append(notification)
+        deleted = []
+        self.memon.delete_messages = lambda q, messages: \
+            deleted.extend(messages)
+
+        self.assertEquals(1, self.memon.poll())
+        self.assertEquals([], notifications)
+        self.assertEquals([], deleted)
+        self.assertEquals(1, self.memon.metrics.values[
+            ('memon_throttled_events', ())])
+
+    @mock_sqs
+    @mock_sns
+    def test_poll_capacity_short(self):
+        self.initSns()
+        self.initSqs()
+        names = ['Event%02d' % (i) for i in xrange(12)]
+        for name in names:
+            self.table.new_item(hash_key=name, attrs=self.ROLLING).put()
+            self.sendAt(name, 8)
+        # 10 writes a second with a second of burst, so saving the 12
+        # events has to wait for the last 2 units
+        self.memon.db = self.db
+        self.memon.capacity.burst = 1
+        self.memon.capacity.provision(self.TABLE_NAME, 1000, 10)
+
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.memon.poll_cycle(2)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        labels = (('kind', 'write'), ('table', self.TABLE_NAME))
+        self.assertEquals(1, self.memon.metrics.values[
+            ('memon_capacity_short', labels)])
+        self.assertGreater(self.memon.metrics.values[
+            ('memon_capacity_wait_seconds', labels)], 0)
+        self.assertNotIn(('memon_capacity_short',
+                          (('kind', 'read'), ('table', self.TABLE_NAME))),
+                         self.memon.metrics.values)
+        self.assertIn('DynamoDB table %s is short of write capacity' %
+                      (self.TABLE_NAME), output)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(1, 2, updated=100)
+        self.assertTrue(bucket.consume(1, 100))
+        self.assertTrue(bucket.consume(1, 100))
+        self.assertFalse(bucket.consume(1, 100))
+        self.assertTrue(bucket.consume(1, 101))
+        self.assertFalse(bucket.consume(1, 101.5))
+        self.assertTrue(bucket.consume(2, 110))
+        self.assertEquals(0, bucket.borrow(2, 112))
+        self.assertEquals(3, bucket.borrow(3, 112))
+
+    def test_serve(self):
+        cycles = []
+
+        def poll_cycle(poll_count):
+            cycles.append(poll_count)
+            if len(cycles) == 2:
+                self.memon.handle_reload(None, None)
+            if len(cycles) == 3:
+                self.memon.handle_stop(None, None)
+            if len(cycles) == 1:
+                raise Exception('Transient failure')
+
+        reloads = []
+        self.memon.interval = 0
+        self.memon.poll_cycle = poll_cycle
+        self.memon.reload = lambda: reloads.append(self.memon.now)
+        self.memon.serve(2)
+        self.assertEqual(cycles, [2, 2, 2])
+        self.assertEqual(len(reloads), 1)
+        self.assertEqual(self.memon.wait_time, 0)
+
 
 if __name__ == '__main__':
     unittest.main()